@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+import eventlog
+import fulltext
+import gc
+import glob
+import io
+import markdown
+import math
+import memory
+import os
+import parse
+import pkgs
+import re
+import shutil
+import sys
+import synth
+import tempfile
+import time
+import tracemalloc
+
+##############################################################################
+# inputs
+
+def document_body(file_name):
+    text = open(file_name).read()
+    start = text.index('\\begin{document}') + len('\\begin{document}')
+    return text[start:text.index('\\end{document}')]
+
+def scaled_document(size, file_name='test-files/0008.tex'):
+    """test-files/0008.tex, with its body repeated until the document
+    is about size characters long"""
+    body = document_body(file_name)
+    copies = max(1, round(size / len(body)))
+    return '\\begin{document}\n' + body * copies + '\\end{document}\n'
+
+##############################################################################
+# measurement
+
+def measure(fn, *args):
+    """Returns (seconds, retained bytes, peak bytes) for a call of fn(*args),
+    as seen by tracemalloc (which slows things down quite a bit)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    # parent pointers make cycles; don't count garbage as retained
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return elapsed, retained, peak
+
+##############################################################################
+# benchmarks
+
+def bench_parse_memory(sizes=(20000, 40000, 80000), chunk_size=8192):
+    """Peak and retained memory (MB) of a whole-document parse against a
+    chunked one. The model grows with the document either way; chunking
+    bounds the peak above it."""
+    print("%10s %12s %12s %12s %12s %12s" % (
+        "size", "whole peak", "retained", "chunked peak", "retained",
+        "over model"))
+    for size in sizes:
+        text = scaled_document(size)
+        _, whole_retained, whole_peak = measure(
+            parse.grammar.model_from_str, text)
+        _, chunked_retained, chunked_peak = measure(
+            parse.model_from_str, text, chunk_size)
+        print("%10d %12.1f %12.1f %12.1f %12.1f %12.1f" % (
+            len(text), whole_peak / 1e6, whole_retained / 1e6,
+            chunked_peak / 1e6, chunked_retained / 1e6,
+            (chunked_peak - chunked_retained) / 1e6))
+
+def bench_replay(file_name='test-files/0008.tex', formats=3):
+    """Seconds to emit formats copies of a document by interpreting it
+    each time, against recording it once and replaying the log."""
+    model = parse.model_from_file(file_name)
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        start = time.perf_counter()
+        for i in range(formats):
+            emitter = markdown.MarkdownEmit(model, out=io.StringIO())
+            pkgs.install_all(emitter)
+            emitter.run()
+        interpreted = time.perf_counter() - start
+        start = time.perf_counter()
+        log = eventlog.record(model)
+        recorded = time.perf_counter() - start
+        for i in range(formats):
+            eventlog.replay(log, markdown.MarkdownEmit, out=io.StringIO())
+        replayed = time.perf_counter() - start - recorded
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log.json')
+            eventlog.save_log(log, path)
+            start = time.perf_counter()
+            log = eventlog.load_log(path)
+            for i in range(formats):
+                eventlog.replay(log, markdown.MarkdownEmit, out=io.StringIO())
+            cached = time.perf_counter() - start
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    print("%d x interpret: %.3fs" % (formats, interpreted))
+    print("record: %.3fs + %d x replay: %.3fs = %.3fs (%d ints, %d strings)" % (
+        recorded, formats, replayed, recorded + replayed,
+        len(log.events), len(log.strings)))
+    print("from a cached log: %.3fs" % cached)
+
+def markdown_terms(model):
+    """The indexing path fulltext replaces: render Markdown, strip the
+    markup, and tokenize what's left."""
+    out = io.StringIO()
+    emitter = markdown.MarkdownEmit(model, out=out)
+    pkgs.install_all(emitter)
+    emitter.run()
+    text = re.sub(r'(?s)<[^>]*>|\$\$.*?\$\$|\$[^$]*\$', ' ', out.getvalue())
+    postings = {}
+    sections = []
+    position = 0
+    for line in text.split('\n'):
+        heading = re.match(r'(#+) (.*)', line)
+        if heading:
+            sections.append([position, len(heading.group(1)), heading.group(2)])
+        for word in re.findall(r'[A-Za-z][A-Za-z0-9]*', line):
+            postings.setdefault(word.lower(), []).append(position)
+            position += 1
+    return postings, sections
+
+def bench_fulltext(copies=20):
+    """Seconds to extract terms from test-files/ repeated copies times,
+    through Markdown and directly, and to write the on-disk index. Each
+    file is parsed once; parsing is the same for both paths."""
+    file_names = sorted(glob.glob('test-files/*.tex'))
+    models = list(parse.model_from_file(file_name) for file_name in file_names)
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        start = time.perf_counter()
+        for i in range(copies):
+            for model in models:
+                markdown_terms(model)
+        stripped = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(copies):
+            for model in models:
+                fulltext.index_model(model)
+        direct = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as directory:
+            index = fulltext.FullTextIndex(os.path.join(directory, 'index.db'))
+            documents = []
+            for i in range(copies):
+                for file_name, model in zip(file_names, models):
+                    copy = os.path.join(directory, '%d-%s' % (i, os.path.basename(file_name)))
+                    shutil.copyfile(file_name, copy)
+                    documents.append((copy, model))
+            start = time.perf_counter()
+            for copy, model in documents:
+                index.update(copy, model)
+            indexed = time.perf_counter() - start
+            index.close()
+            size = os.path.getsize(os.path.join(directory, 'index.db'))
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    print("%d documents" % (copies * len(models)))
+    print("markdown + strip: %.3fs" % stripped)
+    print("IndexEmit:        %.3fs (%.1fx)" % (direct, stripped / direct))
+    print("IndexEmit + db:   %.3fs, %.1f MB" % (indexed, size / 1e6))
+
+def fit_exponent(sizes, values):
+    """Least-squares slope of log(value) against log(size): about 1 for
+    linear growth, 2 for quadratic."""
+    xs = list(math.log(size) for size in sizes)
+    ys = list(math.log(max(value, 1e-9)) for value in values)
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) /
+            sum((x - mean_x) ** 2 for x in xs))
+
+def best_of(n, fn, *args):
+    best = None
+    for i in range(n):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def interpret_markdown(model):
+    emitter = markdown.MarkdownEmit(model, out=io.StringIO())
+    pkgs.install_all(emitter)
+    emitter.run()
+
+def bench_scaling(shapes=sorted(synth.shapes),
+                  sizes=(10000, 20000, 40000, 80000, 160000),
+                  max_exponent=1.25, time_margin=0.15):
+    """Parse and interpret time, model size and interpreter peak memory of
+    synthetic documents against their size. Returns False if any of them
+    grows faster than size ** max_exponent. Times are best-of-3, and
+    still wobble on a busy machine, so they get time_margin on top;
+    quadratic growth fits about 2 either way."""
+    ok = True
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        for shape in shapes:
+            print("%s:" % shape, file=stderr)
+            print("%10s %10s %10s %10s %10s" % (
+                "size", "parse s", "interp s", "model MB", "interp MB"), file=stderr)
+            columns = [[], [], [], []]
+            lengths = []
+            for size in sizes:
+                text = synth.generate(size, shape)
+                lengths.append(len(text))
+                parsed = None
+                for i in range(3):
+                    start = time.perf_counter()
+                    model = parse.model_from_str(text)
+                    elapsed = time.perf_counter() - start
+                    if parsed is None or elapsed < parsed:
+                        parsed = elapsed
+                interpreted = best_of(3, interpret_markdown, model)
+                model_bytes = sum(size for nodes, size in
+                                  memory.model_report(model.statements, 10).values())
+                tracemalloc.start()
+                interpret_markdown(model)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                row = [parsed, interpreted, model_bytes, peak]
+                for column, value in zip(columns, row):
+                    column.append(value)
+                print("%10d %10.3f %10.3f %10.1f %10.1f" % (
+                    len(text), parsed, interpreted, model_bytes / 1e6, peak / 1e6),
+                      file=stderr)
+            exponents = list(fit_exponent(lengths, column) for column in columns)
+            print("%10s %10.2f %10.2f %10.2f %10.2f" % ("exponent", *exponents),
+                  file=stderr)
+            for name, exponent, margin in zip(
+                    ["parse time", "interpret time", "model size", "interpreter peak"],
+                    exponents, [time_margin, time_margin, 0, 0]):
+                if exponent > max_exponent + margin:
+                    print("super-linear: %s %s grows as size^%.2f" % (
+                        shape, name, exponent), file=stderr)
+                    ok = False
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    return ok
+
+def render_markdown(model):
+    """The Markdown for model, or the error that stopped it."""
+    out = io.StringIO()
+    emitter = markdown.MarkdownEmit(model, out=out)
+    pkgs.install_all(emitter)
+    try:
+        emitter.run()
+    except parse.InterpreterRuntimeError as e:
+        return 'error: %s' % e
+    return out.getvalue()
+
+# (before, after) saves; the cache from parsing before must not change
+# how after renders
+chunk_edits = [
+    # the \iffalse loses its \else
+    ('\\iffalse\nold\n\\else\nfinal\n\\fi\nkeep this\n',
+     '\\iffalse\n\\fi\nkeep this\nand this\n'),
+    # the \else and \fi lose their \iffalse
+    ('\\iffalse\nold\n\\else\nfinal\n\\fi\nkeep this\n',
+     'old\n\\else\nfinal\n\\fi\nkeep this\n'),
+    # the \begin{comment} loses its \end
+    ('\\begin{comment}\nhidden\n\\end{comment}\nkeep this\n',
+     '\\begin{comment}\nhidden\n\\end{itemize}\nkeep this\n'),
+    # the '[' loses its ']'
+    ('\\section\n[short\n]{Long}\nkeep this\n',
+     '\\section\n[short\n{Long}\nkeep this\n'),
+    ]
+
+def bench_chunks(chunk_sizes=(1, 100, 4000)):
+    """Checks that chunked parses render like whole-file ones, for the
+    test papers and for edits rendered from a warm cache (as in
+    drive.py --watch). Returns False on any difference."""
+    ok = True
+    cases = []
+    for file_name in sorted(glob.glob('test-files/*.tex')):
+        text = open(file_name).read()
+        cases.append((os.path.basename(file_name), None, text))
+        # a save that appends a paragraph
+        end = text.rindex('\\end{document}')
+        cases.append((os.path.basename(file_name) + ' +par', text,
+                       text[:end] + '\nA new paragraph.\n\n' + text[end:]))
+    for ix, (before, after) in enumerate(chunk_edits):
+        cases.append(('edit %d' % ix, before, after))
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        for name, before, text in cases:
+            whole = render_markdown(parse.model_from_str(text, len(text) + 1))
+            for chunk_size in chunk_sizes:
+                cache = None
+                if before is not None:
+                    cache = {}
+                    render_markdown(parse.model_from_str(before, chunk_size, cache))
+                chunked = render_markdown(parse.model_from_str(text, chunk_size, cache))
+                if chunked != whole:
+                    print("%s, chunk size %d%s: differs from a whole-file parse" % (
+                        name, chunk_size, '' if cache is None else ' (warm)'),
+                          file=stderr)
+                    ok = False
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    if ok:
+        print("%d documents, chunk sizes %s: same as whole-file parses" % (
+            len(cases), ', '.join(map(str, chunk_sizes))))
+    return ok
+
+def bench_shared_leaves(size=200000, shape='paragraphs'):
+    """Retained model memory (MB) without and with shared leaves, for
+    each test paper and for a generated document of about size
+    characters."""
+    print("%-24s %10s %12s %12s %8s" % (
+        "document", "size", "unshared", "shared", "saved"))
+    inputs = list((os.path.basename(file_name), open(file_name).read())
+                  for file_name in sorted(glob.glob('test-files/*.tex')))
+    inputs.append(('synth %s' % shape, synth.generate(size, shape)))
+    totals = [0, 0, 0]
+    for name, text in inputs:
+        _, unshared, _ = measure(parse.model_from_str, text, parse.CHUNK_SIZE, None, False)
+        _, shared, _ = measure(parse.model_from_str, text, parse.CHUNK_SIZE, None, True)
+        if not name.startswith('synth'):
+            totals[0] += len(text)
+            totals[1] += unshared
+            totals[2] += shared
+        else:
+            print("%-24s %10d %12.2f %12.2f %7.0f%%" % (
+                "test-files total", totals[0], totals[1] / 1e6, totals[2] / 1e6,
+                100 * (1 - totals[2] / totals[1])))
+        print("%-24s %10d %12.2f %12.2f %7.0f%%" % (
+            name, len(text), unshared / 1e6, shared / 1e6,
+            100 * (1 - shared / unshared)))
+
+def bench_lazy_blocks(file_names=('test-files/0005.tex', 'test-files/0006.tex',
+                                  'test-files/0007.tex', 'test-files/0008.tex')):
+    """Parse time, retained model memory and parse-and-render time with
+    every block parsed up front, against lazy blocks."""
+    print("%-10s %8s %17s %17s %17s %8s" % (
+        "file", "size", "parse ms", "retained MB", "render ms", "lazy"))
+    eager = parse.make_grammar(None)
+    lazy = parse.grammar
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        for file_name in file_names:
+            text = open(file_name).read()
+            results = []
+            for grammar in (eager, lazy):
+                parse.grammar = grammar
+                parse_time = best_of(5, parse.model_from_str, text)
+                _, retained, _ = measure(parse.model_from_str, text)
+                def render():
+                    interpret_markdown(parse.model_from_str(text))
+                results.append((parse_time * 1e3, retained / 1e6, best_of(5, render) * 1e3))
+            model = parse.model_from_str(text)
+            interpret_markdown(model)
+            blocks = [0, 0] # lazy blocks, still unparsed after rendering
+            stack = [model.statements]
+            while stack:
+                for node in stack.pop():
+                    if isinstance(node, parse.LazyBlock):
+                        blocks[0] += 1
+                        if not node.parsed:
+                            blocks[1] += 1
+                            continue
+                    stack.extend(memory.children(node))
+            (eager_parse, eager_memory, eager_render), (lazy_parse, lazy_memory, lazy_render) = results
+            print("%-10s %8d %8.0f %8.0f %8.2f %8.2f %8.0f %8.0f %4d/%-4d" % (
+                os.path.basename(file_name), len(text), eager_parse, lazy_parse,
+                eager_memory, lazy_memory, eager_render, lazy_render,
+                blocks[1], blocks[0]))
+    finally:
+        parse.grammar = lazy
+        sys.stderr.close()
+        sys.stderr = stderr
+
+benchmarks = {
+    'parse-memory': bench_parse_memory,
+    'chunks': bench_chunks,
+    'lazy-blocks': bench_lazy_blocks,
+    'shared-leaves': bench_shared_leaves,
+    'replay': bench_replay,
+    'fulltext': bench_fulltext,
+    'scaling': bench_scaling,
+    }
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    status = 0
+    for name in names:
+        print("## %s" % name)
+        # benchmarks that check something return False on failure
+        if benchmarks[name]() is False:
+            status = 1
+    sys.exit(status)
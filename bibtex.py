@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import re
+
+##############################################################################
+# BibTeX support
+#
+# Shared lab bibliographies run to several MB and are used by dozens of
+# papers, so we never parse a whole .bib file per paper. The first time
+# we see a file we scan it once for entry keys and their byte spans, and
+# keep that index in a cache keyed by path and mtime. A paper then reads
+# and parses only the entries it cites.
+
+# set to None to disable the on-disk cache
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'latex-parse', 'bibtex')
+
+# in-process cache, so a batch run scans each file at most once
+indices = {}
+
+entry_start = re.compile(
+    rb'^[ \t]*@[ \t]*([A-Za-z]+)[ \t]*[{(][ \t\r\n]*([^,\s{}()]*)', re.MULTILINE)
+entry_header = re.compile(r'\s*@\s*([A-Za-z]+)\s*[{(]')
+# the comma is left out for an entry without fields ('@misc{key}')
+entry_key = re.compile(r'\s*([^,\s{}()]*)\s*(,|(?=[})]))')
+field_name = re.compile(r'[\s,]*([A-Za-z][\w\-:.]*)\s*=\s*')
+bare_value = re.compile(r'[^\s,#{}"]+')
+concatenation = re.compile(r'\s*#\s*')
+
+MONTHS = {
+    'jan': 'January', 'feb': 'February', 'mar': 'March', 'apr': 'April',
+    'may': 'May', 'jun': 'June', 'jul': 'July', 'aug': 'August',
+    'sep': 'September', 'oct': 'October', 'nov': 'November', 'dec': 'December'}
+
+class BibTeXError(Exception):
+    pass
+
+##############################################################################
+# index
+
+class BibIndex:
+
+    def __init__(self, path, mtime, size, spans, strings):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.spans = spans # key -> [start, end] byte offsets
+        self.strings = strings
+        self.entries = {}
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def get(self, key):
+        """Returns the parsed entry for key, or None."""
+        if key in self.entries:
+            return self.entries[key]
+        span = self.spans.get(key)
+        if span is None:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(span[0])
+            source = f.read(span[1] - span[0]).decode('utf-8', 'replace')
+        entry = parse_entry(source, self.strings)
+        self.entries[key] = entry
+        return entry
+
+    def to_json(self):
+        return {'path': self.path, 'mtime': self.mtime, 'size': self.size,
+                'spans': self.spans, 'strings': self.strings}
+
+def scan(path):
+    """Builds a BibIndex by scanning path once for entry boundaries."""
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    spans = {}
+    strings = {}
+    starts = list(entry_start.finditer(data))
+    for i, match in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(data)
+        entry_type = match.group(1).decode('ascii').lower()
+        if entry_type == 'string':
+            source = data[match.start():end].decode('utf-8', 'replace')
+            body = source[entry_header.match(source).end():]
+            try:
+                strings.update(parse_fields(body, strings))
+            except BibTeXError:
+                # uses of a malformed @string are left as they are
+                pass
+        elif entry_type not in ('comment', 'preamble'):
+            key = match.group(2).decode('utf-8', 'replace')
+            if key and key not in spans:
+                spans[key] = [match.start(), end]
+    return BibIndex(os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+                    spans, strings)
+
+def cache_file(path):
+    return os.path.join(
+        cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.json')
+
+def load_index(path):
+    """Returns the BibIndex for path, rescanning only if the file changed."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index = indices.get(path)
+    if index is not None and (index.mtime, index.size) == (stat.st_mtime_ns, stat.st_size):
+        return index
+    index = None
+    if cache_dir is not None:
+        try:
+            with open(cache_file(path)) as f:
+                cached = json.load(f)
+            if (cached['path'], cached['mtime'], cached['size']) == (
+                    path, stat.st_mtime_ns, stat.st_size):
+                index = BibIndex(**cached)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    if index is None:
+        index = scan(path)
+        save_index(index)
+    indices[path] = index
+    return index
+
+def save_index(index):
+    if cache_dir is None:
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        target = cache_file(index.path)
+        tmp = '%s.%d.tmp' % (target, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(index.to_json(), f)
+        os.replace(tmp, target)
+    except OSError:
+        # the cache is an optimization; a read-only home shouldn't stop us
+        pass
+
+##############################################################################
+# entry parsing
+
+def parse_entry(source, strings):
+    """Parses '@type{key, field = value, ...}' into a dict. The entry type
+    and key are stored under 'ENTRYTYPE' and 'ID'."""
+    header = entry_header.match(source)
+    key = header and entry_key.match(source, header.end())
+    if not key:
+        raise BibTeXError("Malformed entry: %s" % source[:40])
+    entry = parse_fields(source[key.end():], strings)
+    entry['ENTRYTYPE'] = header.group(1).lower()
+    entry['ID'] = key.group(1)
+    return entry
+
+def parse_fields(source, strings):
+    fields = {}
+    pos = 0
+    n = len(source)
+    while True:
+        match = field_name.match(source, pos)
+        if match is None:
+            break
+        name = match.group(1).lower()
+        pos = match.end()
+        parts = []
+        while pos < n:
+            c = source[pos]
+            if c == '{':
+                end = matching_brace(source, pos)
+                parts.append(source[pos + 1:end])
+                pos = end + 1
+            elif c == '"':
+                end = pos + 1
+                depth = 0
+                while end < n and (source[end] != '"' or depth > 0):
+                    if source[end] == '{':
+                        depth += 1
+                    elif source[end] == '}':
+                        depth -= 1
+                    end += 1
+                parts.append(source[pos + 1:end])
+                pos = end + 1
+            else:
+                word = bare_value.match(source, pos)
+                if word is None:
+                    break
+                value = word.group(0)
+                parts.append(strings.get(value.lower(),
+                                         MONTHS.get(value.lower(), value)))
+                pos = word.end()
+            hash_sign = concatenation.match(source, pos)
+            if hash_sign is None:
+                break
+            pos = hash_sign.end()
+        fields[name] = ''.join(parts)
+    return fields
+
+def matching_brace(source, pos):
+    depth = 0
+    for end in range(pos, len(source)):
+        c = source[end]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return end
+    raise BibTeXError("Unbalanced braces in entry")
+
+##############################################################################
+# formatting
+
+def plain(value):
+    value = re.sub(r'\\[A-Za-z]+\s*|[{}\\]', '', value)
+    return ' '.join(value.split())
+
+def format_authors(value):
+    names = []
+    for name in re.split(r'\s+and\s+', value):
+        name = plain(name)
+        if ',' in name:
+            last, first = name.split(',', 1)
+            name = '%s %s' % (first.strip(), last.strip())
+        names.append(name)
+    if len(names) > 2:
+        return ', '.join(names[:-1]) + ', and ' + names[-1]
+    return ' and '.join(names)
+
+def format_entry(entry):
+    """A readable one-line rendering of an entry: authors, title, venue, year
+    ('' if it has none of those)."""
+    parts = []
+    if 'author' in entry:
+        parts.append(format_authors(entry['author']))
+    elif 'editor' in entry:
+        parts.append(format_authors(entry['editor']) + ', editors')
+    if 'title' in entry:
+        parts.append(plain(entry['title']))
+    venue = []
+    for field in ['journal', 'booktitle', 'publisher', 'school', 'institution']:
+        if field in entry:
+            venue.append(plain(entry[field]))
+            break
+    for field in ['volume', 'pages']:
+        if field in entry:
+            venue.append(('pp. ' if field == 'pages' else '') +
+                         plain(entry[field]).replace('--', '-'))
+    if 'year' in entry:
+        venue.append(plain(entry['year']))
+    if venue:
+        parts.append(', '.join(venue))
+    if not parts:
+        return ''
+    return '. '.join(parts) + '.'
+
+##############################################################################
+
+def find_bib_file(name, base_dir):
+    """Resolves a \\bibliography{name} entry the way bibtex would for files
+    next to the document; returns None if there is no such file."""
+    if not name.endswith('.bib'):
+        name = name + '.bib'
+    path = os.path.join(base_dir, name)
+    if os.path.exists(path):
+        return path
+    return None
@@ -1,15 +1,161 @@
 #!/usr/bin/env python
 
+import argparse
+import bibtex
+import io
+import os
 import parse
 import pkgs
 import sys
+import time
 
-def parse_file(file_name, cls):
-    model = parse.grammar.model_from_file(file_name)
-    interpreter = cls(model)
+def parse_file(file_name, cls, **kwargs):
+    model = parse.model_from_file(file_name)
+    return model, interpret(model, cls, **kwargs)
+
+def interpret(model, cls, **kwargs):
+    interpreter = cls(model, **kwargs)
     pkgs.install_all(interpreter)
-    return interpreter.run()
+    interpreter.run()
+    return interpreter
+
+def write_atomically(path, text):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+##############################################################################
+# watch mode
+#
+# The grammar, the package setup and every parsed chunk stay warm between
+# renders, so a save costs reparsing the lines that changed plus one
+# interpretation.
+
+# cut at every top-level line, so an edit reparses about one line
+WATCH_CHUNK_SIZE = 1
+
+def dependencies(model, file_name):
+    """Files other than file_name that the output depends on."""
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    result = []
+    statements = model.statements
+    for ix, statement in enumerate(statements[:-1]):
+        if statement.kind != parse.KIND_COMMAND:
+            continue
+        name = statement.command[1:]
+        if name not in ('input', 'include', 'bibliography'):
+            continue
+        if statements[ix + 1].kind != parse.KIND_BLOCK:
+            continue
+        for target in statements[ix + 1].as_string().split(','):
+            target = target.strip()
+            if name == 'bibliography':
+                path = bibtex.find_bib_file(target, base_dir)
+            else:
+                path = os.path.join(base_dir, target)
+                if not os.path.splitext(path)[1]:
+                    path += '.tex'
+            if path is not None:
+                result.append(path)
+    return result
+
+def mtimes(paths):
+    result = {}
+    for path in paths:
+        try:
+            result[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            result[path] = None
+    return result
+
+def render(file_name, cls, output, cache):
+    # pick up figures added since the last render
+    pkgs.graphics_index.listings.clear()
+    model = parse.model_from_file(file_name, WATCH_CHUNK_SIZE, cache)
+    out = io.StringIO()
+    interpret(model, cls, out=out)
+    write_atomically(output, out.getvalue())
+    return model
+
+def watch(file_name, cls, output, interval=0.02, debounce=0.03):
+    cache = {}
+    paths = [file_name]
+    seen = None
+    while True:
+        current = mtimes(paths)
+        if current == seen:
+            time.sleep(interval)
+            continue
+        # wait for a burst of saves to settle before rendering
+        while True:
+            time.sleep(debounce)
+            settled = mtimes(paths)
+            if settled == current:
+                break
+            current = settled
+        start = time.perf_counter()
+        try:
+            model = render(file_name, cls, output, cache)
+        except Exception as e:
+            # a half-typed edit shouldn't end the session
+            print("error: %s" % e, file=sys.stderr)
+        else:
+            paths = [file_name] + dependencies(model, file_name)
+            print("wrote %s in %.0f ms" % (
+                output, (time.perf_counter() - start) * 1000), file=sys.stderr)
+        seen = current
+        if set(paths) != set(seen):
+            seen = mtimes(paths)
+
+##############################################################################
 
 if __name__ == '__main__':
     import markdown
-    parse_file(sys.argv[1], markdown.MarkdownEmit)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file_name')
+    parser.add_argument('-o', '--output',
+                        help='write to this file instead of stdout')
+    parser.add_argument('--watch', action='store_true',
+                        help='re-render to OUTPUT whenever the input changes')
+    parser.add_argument('--pages', metavar='DIRECTORY',
+                        help='write a page per section and a manifest.json there')
+    parser.add_argument('--subsections', action='store_true',
+                        help='with --pages, start a page at subsections too')
+    parser.add_argument('--memory', action='store_true',
+                        help='print a memory report to stderr when done')
+    parser.add_argument('--max-steps', type=int,
+                        help='give up after this many interpreter steps')
+    parser.add_argument('--max-seconds', type=float,
+                        help='give up after this many seconds of interpretation')
+    parser.add_argument('--max-output', type=int,
+                        help='give up after writing this many characters')
+    args = parser.parse_args()
+    budgets = {'max_steps': args.max_steps, 'max_seconds': args.max_seconds,
+               'max_output': args.max_output}
+    try:
+        if args.watch:
+            if args.output is None:
+                parser.error('--watch needs --output')
+            watch(args.file_name, markdown.MarkdownEmit, args.output)
+        elif args.pages is not None:
+            pages = markdown.SectionPages(
+                args.pages, 2 if args.subsections else 1, args.file_name)
+            model, interpreter = parse_file(
+                args.file_name, markdown.MarkdownEmit, out=pages, **budgets)
+            pages.close()
+        elif args.output is not None:
+            out = io.StringIO()
+            model, interpreter = parse_file(
+                args.file_name, markdown.MarkdownEmit, out=out, **budgets)
+            write_atomically(args.output, out.getvalue())
+        else:
+            model, interpreter = parse_file(
+                args.file_name, markdown.MarkdownEmit, **budgets)
+    except parse.BudgetExceeded as e:
+        print("error: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    if args.memory and not args.watch:
+        import memory
+        print(memory.format_report(memory.report(model, interpreter)),
+              file=sys.stderr)
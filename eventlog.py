@@ -0,0 +1,356 @@
+import json
+import labels
+import parse
+import pkgs
+
+##############################################################################
+# record once, emit many
+#
+# Producing several output formats from one paper used to mean
+# interpreting the model once per format. A Recorder interprets it once
+# and keeps the stream of _process events as an EventLog: kind codes and
+# integer references into a string table. Replaying the log into any
+# emitter feeds it the same events without running a single command,
+# and the log serializes to JSON so it can be cached. The log also keeps
+# the document's label numbers (see labels.py), for emitters that
+# resolve references, and its \graphicspath, which is set by a command
+# rather than an event.
+#
+# Emitters get command parameters as blocks and usually push them back
+# into the interpreter (\textbf pushes '**', its argument, '**'). So the
+# recorder also interprets each parameter block, into a group of its
+# own, and on replay parameters are blocks of recorded events. An
+# emitter may well ignore a parameter that can't be interpreted (say, a
+# \label with an unknown command in it), so a failure inside a group
+# is recorded in its place and only raised if a replay gets to it.
+
+# argument references are (index << 2) | tag
+STRING, GROUP, LIST, INT = range(4)
+
+# event kind of a recorded failure
+ERROR = -1
+
+# which argument of an event holds the parameters to interpret
+parameter_args = {
+    parse.KIND_COMMAND: 1,
+    parse.KIND_BEGIN_ENVIRONMENT: 2,
+    }
+
+# commands whose parameters are keys, names or paths, which emitters
+# only ever read as text (parameters of a command in here replay as
+# their text, but no events)
+text_commands = frozenset([
+    'label', 'ref', 'autoref', 'cite', 'href', 'includegraphics',
+    'bibliography', 'bibliographystyle', 'usepackage', 'documentclass',
+    'PassOptionsToPackage',
+    ])
+
+class EventLog:
+
+    def __init__(self, file_name, strings, events, groups, lists, labels=None,
+                 graphics_path=None):
+        self.file_name = file_name
+        self.strings = strings # string table
+        self.events = events   # kind, argc, ref, ..., kind, argc, ref, ...
+        self.groups = groups   # [start, end, text]; group 0 is the document
+        self.lists = lists     # lists of refs
+        self.labels = labels   # key -> [counter, number]
+        self.graphics_path = graphics_path
+        self.statements = None
+
+    def to_json(self):
+        return {'file_name': self.file_name, 'strings': self.strings,
+                'events': self.events, 'groups': self.groups,
+                'lists': self.lists, 'labels': self.labels,
+                'graphics_path': self.graphics_path}
+
+    def document(self):
+        """The document as a list of event statements, built once and
+        shared by every replay."""
+        if self.statements is None:
+            blocks = [None] * len(self.groups)
+            shared = {}
+            # groups are numbered as they're recorded, so any group
+            # referenced from inside a group has a larger number
+            for group in reversed(range(len(self.groups))):
+                start, end, text = self.groups[group]
+                blocks[group] = ReplayBlock(
+                    self.decode_events(start, end, blocks, shared),
+                    self.strings[text])
+            self.statements = blocks[0].statements
+        return self.statements
+
+    def decode_events(self, start, end, blocks, shared):
+        events = self.events
+        result = []
+        ix = start
+        while ix < end:
+            kind, argc = events[ix], events[ix + 1]
+            if argc == 1 and events[ix + 2] & 3 != GROUP:
+                # words and spaces repeat a lot, and events don't change,
+                # so equal ones share a node
+                key = (kind, events[ix + 2])
+                event = shared.get(key)
+                if event is None:
+                    event = event_classes.get(kind, Event)(
+                        kind, [self.decode(events[ix + 2], blocks)])
+                    shared[key] = event
+            else:
+                args = []
+                for ref in events[ix + 2:ix + 2 + argc]:
+                    args.append(self.decode(ref, blocks))
+                event = event_classes.get(kind, Event)(kind, args)
+            result.append(event)
+            ix += 2 + argc
+        return result
+
+    def decode(self, ref, blocks):
+        tag, index = ref & 3, ref >> 2
+        if tag == STRING:
+            return self.strings[index]
+        elif tag == GROUP:
+            return blocks[index]
+        elif tag == LIST:
+            return list(self.decode(item, blocks) for item in self.lists[index])
+        return index
+
+def save_log(log, path):
+    with open(path, 'w') as f:
+        json.dump(log.to_json(), f)
+
+def load_log(path):
+    with open(path) as f:
+        return EventLog(**json.load(f))
+
+##############################################################################
+# recording
+
+class GroupMarker(parse.ModelClass):
+    """Brackets the statements of a parameter block pushed by the
+    recorder; group None closes the innermost group."""
+
+    kind = parse.KIND_NOP
+
+    def __init__(self, group):
+        self.group = group
+
+    def interpret(self, interpreter):
+        # not through _process: groups must close even while ignoring
+        if self.group is None:
+            interpreter.close_group()
+        else:
+            interpreter.open_group(self.group)
+
+    def collect_strings(self, lst):
+        pass
+
+class Recorder(parse.Interpreter):
+
+    def __init__(self, model, *args, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        self.labels = labels.label_table(model)
+        self.strings = []
+        self.string_refs = {}
+        self.lists = []
+        self.group_events = [[]]
+        self.group_texts = [self.intern('')]
+        self.targets = [self.group_events[0]]
+        self.open_groups = [] # (group, frame depth, environment depth)
+        self.pending = []
+
+    def intern(self, value):
+        ix = self.string_refs.get(value)
+        if ix is None:
+            ix = len(self.strings)
+            self.strings.append(value)
+            self.string_refs[value] = ix
+        return ix
+
+    def ref(self, value, interpret):
+        if isinstance(value, str):
+            return self.intern(value) << 2 | STRING
+        elif isinstance(value, int):
+            return value << 2 | INT
+        elif isinstance(value, parse.Block):
+            group = len(self.group_events)
+            self.group_events.append([])
+            self.group_texts.append(self.intern(value.as_string()))
+            if interpret:
+                self.pending.append(
+                    [GroupMarker(group)] + value.statements + [GroupMarker(None)])
+            return group << 2 | GROUP
+        elif isinstance(value, list):
+            refs = list(self.ref(item, interpret) for item in value)
+            self.lists.append(refs)
+            return (len(self.lists) - 1) << 2 | LIST
+        elif isinstance(value, parse.ModelClass):
+            return self.intern(value.as_string()) << 2 | STRING
+        raise parse.InterpreterRuntimeError(
+            "Can't record %s argument %r" % (type(value).__name__, value))
+
+    # this runs for every event, so it is _process and process in one
+    def _process(self, kind, *args):
+        if not self.processing:
+            return
+        target = self.targets[-1]
+        if not args:
+            # spaces and line breaks
+            target.extend((kind, 0))
+            return
+        if len(args) == 1 and type(args[0]) is str:
+            # words and punctuation
+            ix = self.string_refs.get(args[0])
+            if ix is None:
+                ix = self.intern(args[0])
+            target.extend((kind, 1, ix << 2 | STRING))
+            return
+        # optional parameters, end_environment's repeated parameters,
+        # block statements (which are interpreted next anyway) and the
+        # parameters of text_commands are only kept as text
+        interpret = parameter_args.get(kind)
+        if interpret is not None and args[0] in text_commands:
+            interpret = None
+        target.append(kind)
+        target.append(len(args))
+        for ix, arg in enumerate(args):
+            if type(arg) is str:
+                target.append(self.intern(arg) << 2 | STRING)
+            else:
+                target.append(self.ref(arg, ix == interpret))
+        if self.pending:
+            # parameters belong to the caller, not to the command's own frame
+            caller = self.param_stack[-2] if len(self.param_stack) > 1 else []
+            # one frame each, so a failing one can be dropped on its own
+            for statements in reversed(self.pending):
+                self.push_block(statements, caller)
+            self.pending = []
+
+    def open_group(self, group):
+        self.open_groups.append(
+            (group, len(self.statement_stream), len(self.environment_stack)))
+        self.targets.append(self.group_events[group])
+
+    def close_group(self):
+        self.open_groups.pop()
+        self.targets.pop()
+
+    def run_steps(self):
+        # (catching failures here rather than in step keeps the step loop
+        # as cheap as a plain interpreter's)
+        while True:
+            try:
+                return super().run_steps()
+            except (parse.ExpansionLimitError, parse.BudgetExceeded):
+                raise
+            except Exception as e:
+                if not self.open_groups:
+                    raise
+                self.abandon_group(e)
+
+    def abandon_group(self, error):
+        """Replaces the events of the innermost open group by the error,
+        and drops what is left of its frame."""
+        group, depth, environments = self.open_groups.pop()
+        self.targets.pop()
+        self.group_events[group][:] = [ERROR, 1, self.ref(repr(error), False)]
+        while len(self.statement_stream) >= depth:
+            self.statement_stream.pop()
+            self.cursor.pop()
+            self.consumed.pop()
+            self.param_stack.pop()
+        del self.environment_stack[environments:]
+        self.advance()
+
+    def log(self):
+        events = []
+        groups = []
+        for group_events, text in zip(self.group_events, self.group_texts):
+            groups.append([len(events), len(events) + len(group_events), text])
+            events.extend(group_events)
+        return EventLog(self.file_name, self.strings, events, groups, self.lists,
+                        self.labels, getattr(self, 'graphics_path', None))
+
+def record(model, **kwargs):
+    """Interprets model once and returns its EventLog."""
+    recorder = Recorder(model, **kwargs)
+    pkgs.install_all(recorder)
+    recorder.run()
+    return recorder.log()
+
+##############################################################################
+# replay
+
+class Event(parse.ModelClass):
+
+    kind = parse.KIND_NOP
+
+    def __init__(self, event_kind, args):
+        self.event_kind = event_kind
+        self.args = args
+
+    def interpret(self, interpreter):
+        interpreter._process(self.event_kind, *self.args)
+
+    def collect_strings(self, lst):
+        pass
+
+class ErrorEvent(Event):
+
+    def interpret(self, interpreter):
+        raise parse.InterpreterRuntimeError(
+            "Replayed a parameter that failed to record: %s" % self.args[0])
+
+class BeginEnvironmentEvent(Event):
+
+    def interpret(self, interpreter):
+        interpreter.push_environment(self.args[0])
+        interpreter._process(self.event_kind, *self.args)
+
+class EndEnvironmentEvent(Event):
+
+    def interpret(self, interpreter):
+        interpreter._process(self.event_kind, *self.args)
+        interpreter.pop_environment()
+
+event_classes = {
+    ERROR: ErrorEvent,
+    parse.KIND_BEGIN_ENVIRONMENT: BeginEnvironmentEvent,
+    parse.KIND_END_ENVIRONMENT: EndEnvironmentEvent,
+    }
+
+class ReplayBlock(parse.Block):
+    """A recorded parameter: its events, and its original text for
+    as_string."""
+
+    def __init__(self, statements, text):
+        super().__init__(statements=statements)
+        self.text = text
+
+    def collect_strings(self, lst):
+        lst.append(self.text)
+
+class Document:
+
+    def __init__(self, statements, file_name, labels=None):
+        self.statements = statements
+        self._tx_filename = file_name
+        self.labels = labels
+
+def replay(log, cls, **kwargs):
+    """Runs a fresh cls emitter over the recorded events."""
+    emitter = cls(Document([], log.file_name, log.labels), **kwargs)
+    if log.graphics_path is not None:
+        emitter.graphics_path = log.graphics_path
+    stream = emitter.statement_stream
+    # events go straight to the emitter; the interpreter only steps
+    # through what the emitter pushes back
+    for event in log.document():
+        if type(event) is Event and emitter.processing:
+            # (what Event.interpret does, a call shorter)
+            emitter.process(event.event_kind, *event.args)
+        else:
+            event.interpret(emitter)
+        while len(stream) > 1:
+            emitter.step()
+    emitter.run()
+    return emitter
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+from array import array
+import argparse
+import bisect
+import os
+import parse
+import pkgs
+import sqlite3
+import sys
+
+##############################################################################
+# full-text indexing
+#
+# IndexEmit takes terms straight from Word events instead of rendering
+# Markdown and stripping the markup off again. Only the document body
+# counts: the preamble, comments and math produce no terms. Each term
+# occurrence gets its word position in the document, and section and
+# subsection commands record where each section starts, so a hit can be
+# reported with its section.
+
+section_levels = {
+    'section': 1, 'section*': 1, 'firstsection': 1,
+    'subsection': 2, 'subsection*': 2,
+    'subsubsection': 3, 'subsubsection*': 3,
+    }
+
+# commands whose parameter (by index) is running text
+text_parameters = {
+    'textbf': 0, 'emph': 0, 'texttt': 0, 'caption': 0, 'footnote': 0,
+    'marginpar': 0, 'acknowledgments': 0, 'paragraph': 0, 'paragraph*': 0,
+    'rotatebox': 1,
+    }
+
+# statements whose interpretation is nothing but their own event
+text_kinds = frozenset([
+    parse.KIND_WORD, parse.KIND_WHITESPACE, parse.KIND_LINEBREAK,
+    parse.KIND_PUNCTUATION, parse.KIND_NUMBER, parse.KIND_COMMENT,
+    parse.KIND_MATH])
+
+class IndexEmit(parse.Interpreter):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_document = False
+        self.in_math = False
+        self.position = 0
+        self.postings = {} # term -> [positions]
+        self.sections = [] # [start position, level, title]
+        self.dispatch = parse.dispatch_table({
+            parse.KIND_WORD: self.process_word,
+            parse.KIND_COMMAND: self.process_command,
+            parse.KIND_BEGIN_ENVIRONMENT: self.process_begin_environment,
+            parse.KIND_END_ENVIRONMENT: self.process_end_environment,
+            parse.KIND_MATHTOGGLE: self.process_mathtoggle,
+            }, lambda kind: self.ignore)
+
+    def process(self, kind, *args):
+        self.dispatch[kind](*args)
+
+    def run(self):
+        # Most statements are plain text, and only words matter here, so
+        # runs of them are read off the current block directly; only the
+        # rest goes through step(). Blocks end in a NOP sentinel, so a
+        # run never reaches past the end of one.
+        self.bind_commands()
+        self.report_mismatches()
+        self.start_budgets()
+        stream = self.statement_stream
+        cursor = self.cursor
+        consumed = self.consumed
+        while cursor:
+            if self.steps >= self.next_check:
+                self.check_budgets()
+            statements = stream[-1]
+            ix = cursor[-1]
+            statement = statements[ix]
+            if statement.kind in text_kinds:
+                indexing = self.processing and self.in_document and not self.in_math
+                while statement.kind in text_kinds:
+                    if indexing and statement.kind == parse.KIND_WORD:
+                        self.process_word(statement.word)
+                    ix += 1
+                    statement = statements[ix]
+                cursor[-1] = consumed[-1] = ix
+            self.step()
+            self.steps += 1
+
+    def ignore(self, *args):
+        pass
+
+    def process_word(self, word):
+        if self.in_document and not self.in_math:
+            term = word.lower()
+            positions = self.postings.get(term)
+            if positions is None:
+                self.postings[term] = [self.position]
+            else:
+                positions.append(self.position)
+            self.position += 1
+
+    def process_command(self, command_name, params, optionals):
+        if not self.in_document:
+            return
+        level = section_levels.get(command_name)
+        if level is not None:
+            self.sections.append(
+                [self.position, level, ' '.join(params[0].as_string().split())])
+            self.push_block(params[0])
+            return
+        ix = text_parameters.get(command_name)
+        if ix is not None and ix < len(params):
+            self.push_block(params[ix])
+
+    def process_begin_environment(self, name, *args):
+        if name == 'document':
+            self.in_document = True
+
+    def process_end_environment(self, name, *args):
+        if name == 'document':
+            self.in_document = False
+
+    def process_mathtoggle(self):
+        # math spans are a single event; this is for a stray '$'
+        self.in_math = not self.in_math
+
+def index_model(model):
+    """Returns the IndexEmit that has run over model."""
+    emitter = IndexEmit(model)
+    pkgs.install_all(emitter)
+    emitter.run()
+    return emitter
+
+##############################################################################
+# on-disk inverted index
+#
+# One row per (term, document), holding the term's positions in that
+# document; sections are stored by starting position. Updating a document
+# replaces its rows in one transaction, and documents whose mtime and
+# size haven't changed are skipped.
+
+schema = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    length INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS sections (
+    document INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    title TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS sections_by_document ON sections (document, start);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    document INTEGER NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term, document)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_document ON postings (document);
+"""
+
+class FullTextIndex:
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        # a crash may lose the last few updates, but never corrupts the
+        # index, and each update doesn't wait for a full sync
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def document_id(self, path):
+        row = self.db.execute(
+            "SELECT id FROM documents WHERE path = ?", (path,)).fetchone()
+        return row and row[0]
+
+    def is_current(self, file_name):
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        row = self.db.execute(
+            "SELECT mtime, size FROM documents WHERE path = ?", (path,)).fetchone()
+        return row is not None and tuple(row) == (stat.st_mtime_ns, stat.st_size)
+
+    def update(self, file_name, model=None):
+        """Indexes file_name, unless it hasn't changed since it was last
+        indexed. Returns True if it was (re)indexed."""
+        if model is None and self.is_current(file_name):
+            return False
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        if model is None:
+            model = parse.model_from_file(path)
+        emitter = index_model(model)
+        with self.db:
+            self.delete(path)
+            cursor = self.db.execute(
+                "INSERT INTO documents (path, mtime, size, length) VALUES (?, ?, ?, ?)",
+                (path, stat.st_mtime_ns, stat.st_size, emitter.position))
+            document = cursor.lastrowid
+            self.db.executemany(
+                "INSERT INTO sections VALUES (?, ?, ?, ?)",
+                ((document, start, level, title)
+                 for start, level, title in emitter.sections))
+            self.db.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                ((term, document, array('I', positions).tobytes())
+                 for term, positions in emitter.postings.items()))
+        return True
+
+    def delete(self, path):
+        document = self.document_id(path)
+        if document is None:
+            return
+        self.db.execute("DELETE FROM postings WHERE document = ?", (document,))
+        self.db.execute("DELETE FROM sections WHERE document = ?", (document,))
+        self.db.execute("DELETE FROM documents WHERE id = ?", (document,))
+
+    def remove(self, file_name):
+        with self.db:
+            self.delete(os.path.abspath(file_name))
+
+    def search(self, term):
+        """Returns (path, section title, position) for every occurrence
+        of term, by document and position."""
+        result = []
+        rows = self.db.execute(
+            "SELECT documents.path, documents.id, postings.positions "
+            "FROM postings JOIN documents ON postings.document = documents.id "
+            "WHERE postings.term = ? ORDER BY documents.path", (term.lower(),))
+        for path, document, blob in rows.fetchall():
+            sections = self.db.execute(
+                "SELECT start, title FROM sections WHERE document = ? "
+                "ORDER BY start", (document,)).fetchall()
+            starts = list(start for start, title in sections)
+            positions = array('I')
+            positions.frombytes(blob)
+            for position in positions:
+                ix = bisect.bisect_right(starts, position) - 1
+                result.append((path, sections[ix][1] if ix >= 0 else '', position))
+        return result
+
+##############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database')
+    parser.add_argument('file_names', nargs='*',
+                        help='documents to (re)index if they changed')
+    parser.add_argument('-s', '--search', help='print the occurrences of a term')
+    args = parser.parse_args()
+    index = FullTextIndex(args.database)
+    for file_name in args.file_names:
+        try:
+            if index.update(file_name):
+                print("indexed", file_name, file=sys.stderr)
+        except Exception as e:
+            print("error indexing %s: %s" % (file_name, e), file=sys.stderr)
+    if args.search:
+        for path, section, position in index.search(args.search):
+            print("%s\t%s\t%d" % (path, section, position))
+    index.close()
@@ -0,0 +1,126 @@
+import parse
+import re
+
+##############################################################################
+# label numbering
+#
+# \autoref and \ref need the number of whatever a \label names, and the
+# label may well come after the reference. Rather than interpreting the
+# paper twice, number_labels walks the model once, in document order,
+# keeping nothing but LaTeX's section, figure, table and equation
+# counters. As in LaTeX, sections step their counter on the command,
+# floats on their \caption (so a \teaser counts as a figure), and
+# equations on every numbered row of a math environment; a \label gets
+# the number stepped last. Regions the interpreter always skips
+# (\iffalse, \ifpdf, comment environments) are skipped here as well, and
+# so are lazy blocks that can't contain anything counted.
+
+section_levels = {
+    'section': 1, 'firstsection': 1, 'subsection': 2, 'subsubsection': 3,
+    }
+
+float_environments = {
+    'figure': 'figure', 'figure*': 'figure', 'table': 'table', 'table*': 'table',
+    }
+
+# commands whose parameter is a float of its own
+float_commands = {
+    'teaser': 'figure',
+    }
+
+math_label = re.compile(r'\\label\{([^}]*)\}')
+numbered_math = re.compile(
+    r'\\begin\{(equation|align|gather|multline|eqnarray)\}(.*)\\end\{\1\}$', re.S)
+single_row_math = frozenset(['equation', 'multline'])
+unnumbered_row = re.compile(r'\\(nonumber|notag)(?![a-zA-Z])')
+
+counted = re.compile(r'\\(label|caption|(sub)*section|firstsection)(?![a-zA-Z])')
+
+def number_labels(statements):
+    """{key: (counter, number)} for every \\label under statements, where
+    counter is 'section', 'figure', 'table' or 'equation' and number is
+    as LaTeX would print it ('2.1')."""
+    labels = {}
+    sections = [0, 0, 0]
+    counters = {'figure': 0, 'table': 0, 'equation': 0}
+    section = current = ('section', '')
+    floats = []
+    stack = [[statements, 0, False]] # statements, next index, opened a float
+    while stack:
+        frame = stack[-1]
+        statements, ix, opened_float = frame
+        if ix >= len(statements):
+            stack.pop()
+            if opened_float:
+                floats.pop()
+                current = section
+            continue
+        statement = statements[ix]
+        frame[1] = ix + 1
+        kind = statement.kind
+        if kind == parse.KIND_BLOCK:
+            if statement.parsed or counted.search(statement.text):
+                stack.append([statement.statements, 0, False])
+            continue
+        if kind == parse.KIND_MATH:
+            match = numbered_math.match(statement.math.strip())
+            if match is None:
+                continue
+            environment, body = match.groups()
+            rows = [body] if environment in single_row_math else body.split('\\\\')
+            saved = current
+            for row in rows:
+                if unnumbered_row.search(row) is None:
+                    counters['equation'] += 1
+                    current = ('equation', str(counters['equation']))
+                for key in math_label.findall(row):
+                    labels[key.strip()] = current
+            # the environment is a group, so its number doesn't outlive it
+            current = saved
+            continue
+        if kind != parse.KIND_COMMAND:
+            continue
+        name = statement.command[1:]
+        argument = statements[ix + 1] if ix + 1 < len(statements) else None
+        if argument is not None and argument.kind != parse.KIND_BLOCK:
+            argument = None
+        if name == 'iffalse' and statement.fi_offset is not None:
+            if statement.else_offset is not None:
+                frame[1] = ix + statement.else_offset + 1
+            else:
+                frame[1] = ix + statement.fi_offset
+        elif name in ('ifpdf', 'else') and statement.fi_offset is not None:
+            frame[1] = ix + statement.fi_offset
+        elif name == 'begin':
+            environment = parse.environment_name(statements, ix)
+            if environment == 'comment' and statement.end_offset is not None:
+                frame[1] = ix + statement.end_offset + 2
+            elif environment in float_environments:
+                floats.append(float_environments[environment])
+        elif name == 'end':
+            if parse.environment_name(statements, ix) in float_environments and floats:
+                floats.pop()
+                current = section
+        elif name in section_levels:
+            level = section_levels[name]
+            sections[level - 1] += 1
+            sections[level:] = [0] * (3 - level)
+            section = current = ('section', '.'.join(map(str, sections[:level])))
+        elif name == 'caption' and floats:
+            counters[floats[-1]] += 1
+            current = (floats[-1], str(counters[floats[-1]]))
+        elif name == 'label' and argument is not None:
+            labels[argument.as_string().strip()] = current
+            frame[1] = ix + 2
+        elif name in float_commands and argument is not None:
+            floats.append(float_commands[name])
+            frame[1] = ix + 2
+            stack.append([argument.statements, 0, True])
+    return labels
+
+def label_table(model):
+    """The labels of model, numbered the first time they're asked for."""
+    labels = getattr(model, 'labels', None)
+    if labels is None:
+        labels = model.labels = number_labels(model.statements)
+    return labels
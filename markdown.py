@@ -1,37 +1,59 @@
+import bibtex
+import json
+import labels
+import os
 import parse
+import pkgs
 import sys
 
 ##############################################################################
 
+autoref_names = {
+    'section': 'Section', 'figure': 'Figure', 'table': 'Table',
+    'equation': 'Equation',
+    }
+
 class MarkdownEmit(parse.Interpreter):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, model, *args, out=None, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        self.out = out if out is not None else sys.stdout
+        self.labels = labels.label_table(model)
         self.skip_linebreak = False
         self.linebreak_count = 0
         self.needs_par_flush = 0
+        self.citations = {} # key -> number, in order of first citation
+        self.missing_graphics = []
+        self.dispatch = parse.dispatch_table({
+            parse.KIND_COMMAND: self.process_command,
+            parse.KIND_CALLBACK: self.process_callback,
+            parse.KIND_ECHO: self.process_echo,
+            parse.KIND_BEGIN_ENVIRONMENT: self.process_begin_environment,
+            parse.KIND_END_ENVIRONMENT: self.process_end_environment,
+            parse.KIND_WHITESPACE: self.process_whitespace,
+            parse.KIND_MATHTOGGLE: self.process_mathtoggle,
+            parse.KIND_MATH: self.process_math,
+            parse.KIND_LINEBREAK: self.process_linebreak,
+            parse.KIND_COMMENT: self.process_comment,
+            parse.KIND_BLOCK: self.process_block,
+            parse.KIND_PUNCTUATION: self.process_punctuation,
+            parse.KIND_PARAMETER_USE: self.process_parameter_use,
+            parse.KIND_WORD: self.process_word,
+            parse.KIND_NUMBER: self.process_number,
+            }, self.process_unknown)
+        self.command_dispatch = self.make_command_dispatch()
     
     def process(self, kind, *args):
-        dispatch = {
-            "command": self.process_command,
-            "callback": self.process_callback,
-            "echo": self.process_echo,
-            "begin_environment": self.process_begin_environment,
-            "end_environment": self.process_end_environment,
-            "whitespace": self.process_whitespace,
-            "mathtoggle": self.process_mathtoggle,
-            "linebreak": self.process_linebreak,
-            "comment": self.process_comment,
-            "block": self.process_block,
-            "punctuation": self.process_punctuation,
-            "parameter_use": self.process_parameter_use,
-            "word": self.process_word,
-            "number": self.process_number,
-            }
-        if kind in dispatch:
-            dispatch[kind](*args)
-        else:
-            print("MD process", kind, args, file=sys.stderr)
+        self.dispatch[kind](*args)
+
+    def write(self, text):
+        self.add_output(len(text))
+        self.out.write(text)
+
+    def process_unknown(self, kind):
+        def process_it(*args):
+            print("MD process", parse.KIND_NAMES[kind], args, file=sys.stderr)
+        return process_it
 
     def process_begin_environment(self, name, *args):
         dispatch = {
@@ -71,13 +93,20 @@ class MarkdownEmit(parse.Interpreter):
         
     def process_echo(self, value):
         self.linebreak_count = 0
-        print(value, end='')
+        self.write(value)
 
     def process_callback(self, value):
         value()
 
     def process_mathtoggle(self):
-        print('$', end='')
+        self.write('$')
+
+    def process_math(self, math):
+        self.linebreak_count = 0
+        if '\\label' in math:
+            for key in labels.math_label.findall(math):
+                self.write(self.label_anchor(key.strip()))
+        self.write(math)
     
     ##########################################################################
     # commands
@@ -86,12 +115,19 @@ class MarkdownEmit(parse.Interpreter):
         pass
             
     def process_command(self, command_name, params, optionals):
-        dispatch = {
+        if command_name in self.command_dispatch:
+            self.command_dispatch[command_name](params, optionals)
+        else:
+            print("MD process command", command_name, params, optionals, file=sys.stderr)
+
+    def make_command_dispatch(self):
+        return {
             "LaTeX": self.process_command_latex,
             "PassOptionsToPackage": self.nop,
             "TeX": self.process_command_tex,
             "\\": self.process_command_linebreak,
             "autoref": self.process_command_autoref,
+            "bibliography": self.process_command_bibliography,
             "caption": self.process_command_caption,
             "centering": self.nop,
             "cite": self.process_command_cite,
@@ -100,9 +136,12 @@ class MarkdownEmit(parse.Interpreter):
             "emph": self.process_command_emph,
             "firstsection": self.process_command_section,
             "href": self.process_command_href,
+            "includegraphics": self.process_command_includegraphics,
             "item": self.process_command_item,
+            "label": self.process_command_label,
             "maketitle": self.process_command_maketitle,
             "marginpar": self.process_command_marginpar,
+            "ref": self.process_command_ref,
             "rotatebox": self.process_command_rotatebox,
             "section": self.process_command_section,
             "subsection": self.process_command_subsection,
@@ -122,16 +161,12 @@ class MarkdownEmit(parse.Interpreter):
             "scriptsize": self.process_command_font_size("scriptsize"),
             "tiny": self.process_command_font_size("tiny"),
         }
-        if command_name in dispatch:
-            dispatch[command_name](params, optionals)
-        else:
-            print("MD process command", command_name, params, optionals, file=sys.stderr)
 
 
     def flush_paragraph_style(self):
         while self.needs_par_flush > 0:
             self.needs_par_flush -= 1
-            print("</span>", end='')
+            self.write("</span>")
         
     def process_command_font_size(self, fontsize):
         def process_it(params, optionals):
@@ -143,6 +178,15 @@ class MarkdownEmit(parse.Interpreter):
     def process_command_href(self, params, optionals):
         self.push_block([parse.echo("<%s>" % params[0].as_string())])
 
+    def process_command_includegraphics(self, params, optionals):
+        name = params[0].as_string()
+        path = pkgs.resolve_graphics(self, name, pkgs.web_graphics_extensions)
+        if path is None:
+            print("MD missing graphics", name, file=sys.stderr)
+            self.missing_graphics.append(name)
+            path = name
+        self.push_block([parse.echo("<img src='%s'/>" % path)])
+
     def process_command_marginpar(self, params, optionals):
         def start_environ():
             self.push_environment("marginpar")
@@ -157,12 +201,72 @@ class MarkdownEmit(parse.Interpreter):
         self.push_block([parse.echo("...")])
 
     def process_command_cite(self, params, optionals):
+        links = []
+        for key in params[0].as_string().split(','):
+            key = key.strip()
+            number = self.citations.setdefault(key, len(self.citations) + 1)
+            links.append("<a href='#cite-%s'>%d</a>" % (key, number))
         self.push_block([parse.echo(
-            "<span class='cite'>%s</span>" % params[0].as_string())])
+            "<span class='cite'>[%s]</span>" % ", ".join(links))])
+
+    def process_command_bibliography(self, params, optionals):
+        base_dir = os.path.dirname(self.file_name) if self.file_name else '.'
+        indices = []
+        for name in params[0].as_string().split(','):
+            path = bibtex.find_bib_file(name.strip(), base_dir)
+            if path is None:
+                print("MD missing bibliography", name.strip(), file=sys.stderr)
+            else:
+                indices.append(bibtex.load_index(path))
+        lines = ["<div class='bibliography'>\n"]
+        for key, number in self.citations.items():
+            entry = None
+            try:
+                for index in indices:
+                    entry = index.get(key)
+                    if entry is not None:
+                        break
+                else:
+                    if indices:
+                        print("MD missing citation", key, file=sys.stderr)
+            except bibtex.BibTeXError as e:
+                # one bad entry in a shared .bib shouldn't stop the paper
+                print("MD malformed citation", key, e, file=sys.stderr)
+            if entry is None:
+                text = key
+            else:
+                text = bibtex.format_entry(entry) or key
+            lines.append("<p id='cite-%s'>[%d] %s</p>\n" % (key, number, text))
+        lines.append("</div>")
+        self.push_block([parse.echo("".join(lines))])
+
+    def label_anchor(self, key):
+        return "<a id='label-%s'></a>" % key
+
+    def process_command_label(self, params, optionals):
+        self.push_block([parse.echo(self.label_anchor(params[0].as_string().strip()))])
 
     def process_command_autoref(self, params, optionals):
-        self.push_block([parse.echo(
-            "<span class='autoref'>%s</span>" % params[0].as_string())])
+        key = params[0].as_string().strip()
+        target = self.labels.get(key)
+        if target is None:
+            print("MD missing label", key, file=sys.stderr)
+            self.push_block([parse.echo(
+                "<span class='autoref'>%s</span>" % params[0].as_string())])
+            return
+        counter, number = target
+        self.push_block([parse.echo("<a class='autoref' href='#label-%s'>%s %s</a>" % (
+            key, autoref_names[counter], number))])
+
+    def process_command_ref(self, params, optionals):
+        key = params[0].as_string().strip()
+        target = self.labels.get(key)
+        if target is None:
+            print("MD missing label", key, file=sys.stderr)
+            self.push_block([parse.echo("??")])
+            return
+        self.push_block([parse.echo("<a class='ref' href='#label-%s'>%s</a>" % (
+            key, target[1]))])
 
     def process_command_caption(self, params, optionals):
         self.push_block([parse.echo(r"<div class='caption'>")] +
@@ -215,21 +319,29 @@ class MarkdownEmit(parse.Interpreter):
                         [parse.echo('*')])
 
     def process_command_linebreak(self, params, optional_params):
-        print("<br/>", end='')
+        self.write("<br/>")
+
+    def start_section(self, level, title):
+        # lets a SectionPages out start its next page
+        start = getattr(self.out, 'start_section', None)
+        if start is not None:
+            start(level, ' '.join(title.as_string().split()))
 
     def process_command_section(self, params, optional_params):
         self.linebreak_count = 0
-        print("# ", end='')
+        self.start_section(1, params[0])
+        self.write("# ")
         self.push_block(params[0])
 
     def process_command_subsection(self, params, optional_params):
         self.linebreak_count = 0
-        print("## ", end='')
+        self.start_section(2, params[0])
+        self.write("## ")
         self.push_block(params[0])
 
     def process_command_subsubsection(self, params, optional_params):
         self.linebreak_count = 0
-        print("### ", end='')
+        self.write("### ")
         self.push_block(params[0])
 
     def nop(self, *args):
@@ -249,7 +361,7 @@ class MarkdownEmit(parse.Interpreter):
             self.skip_linebreak = False
         else:
             if self.linebreak_count < 2:
-                print("\n", end='')
+                self.write("\n")
             self.linebreak_count += 1
             if self.linebreak_count == 2:
                 self.flush_paragraph_style()
@@ -261,15 +373,15 @@ class MarkdownEmit(parse.Interpreter):
         self.skip_linebreak = True
 
     def process_whitespace(self, *args):
-        print(" ", end='')
+        self.write(" ")
 
     def process_word(self, word):
         self.linebreak_count = 0
-        print(word, end='')
+        self.write(word)
 
     def process_number(self, number):
         self.linebreak_count = 0
-        print(number, end='')
+        self.write(number)
 
     def process_punctuation(self, p):
         self.linebreak_count = 0
@@ -278,7 +390,74 @@ class MarkdownEmit(parse.Interpreter):
             "\{": "{",
             "\}": "}",
             }
-        print(dispatch.get(p, p), end='')
+        self.write(dispatch.get(p, p))
 
 ##############################################################################
-
+# per-section pages
+#
+# Given as MarkdownEmit's out, SectionPages starts a new file at every
+# section (and, with levels=2, subsection), so a long paper can be served
+# a page at a time without ever holding all of it. Each page is moved
+# into place as soon as the next one starts; whatever comes before the
+# first section is page 0. close() writes manifest.json, listing every
+# page with its title, an anchor made from the title, and its size in
+# bytes. Concatenated, the pages are exactly the single-stream output.
+
+def anchor_name(title, taken):
+    words = ''.join(c if c.isalnum() else ' ' for c in title.lower()).split()
+    base = '-'.join(words) or 'section'
+    anchor = base
+    n = 1
+    while anchor in taken:
+        n += 1
+        anchor = '%s-%d' % (base, n)
+    taken.add(anchor)
+    return anchor
+
+class SectionPages:
+
+    def __init__(self, directory, levels=1, file_name=None):
+        self.directory = directory
+        self.levels = levels
+        self.file_name = file_name
+        self.pages = []
+        self.anchors = set()
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start_section(self, level, title):
+        if level <= self.levels:
+            self.start_page(level, title)
+
+    def start_page(self, level, title):
+        self.finish_page()
+        name = 'page-%03d.md' % len(self.pages)
+        self.pages.append({
+            'file': name, 'title': title, 'level': level,
+            'anchor': anchor_name(title, self.anchors) if level else 'front',
+            'bytes': 0})
+        self.file = open(self.page_path(name) + '.tmp', 'w', encoding='utf-8')
+
+    def page_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def finish_page(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        path = self.page_path(self.pages[-1]['file'])
+        os.replace(path + '.tmp', path)
+        self.pages[-1]['bytes'] = os.path.getsize(path)
+
+    def write(self, text):
+        if self.file is None:
+            self.start_page(0, '')
+        self.file.write(text)
+
+    def close(self):
+        self.finish_page()
+        manifest = self.page_path('manifest.json')
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({'file_name': self.file_name, 'pages': self.pages}, f, indent=1)
+        os.replace(manifest + '.tmp', manifest)
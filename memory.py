@@ -0,0 +1,161 @@
+import bibtex
+import io
+import parse
+import pkgs
+import sys
+
+##############################################################################
+# memory accounting
+#
+# Rough, cheap answers to "where did this worker's memory go": the model
+# (nodes and approximate bytes by class), whatever the textX parser still
+# holds on to, the interpreter's frames and its emitter's buffers, and
+# the module-level package state that outlives a document. Sizes are
+# sys.getsizeof of each object, its attribute dict and the strings and
+# lists it owns, so shared strings are counted once per owner. Shared
+# leaves (parse.share_leaves) are counted once, however often they occur.
+# With sample=n only every nth node of a class is measured and the byte
+# count extrapolated; node counts are always exact.
+
+def children(node):
+    """The statement lists directly under node (none, for a lazy block
+    that hasn't been parsed)."""
+    if not getattr(node, 'parsed', True):
+        return
+    statements = getattr(node, 'statements', None)
+    if statements:
+        yield statements
+    for optional in getattr(node, 'optional_parameters', None) or ():
+        yield optional.statements
+
+def node_size(node):
+    size = sys.getsizeof(node)
+    attributes = getattr(node, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        for name, value in attributes.items():
+            if name != 'parent' and isinstance(value, (str, list)):
+                size += sys.getsizeof(value)
+    return size
+
+def model_report(statements, sample=1):
+    """{class name: [nodes, approximate bytes]} for the nodes under the
+    statement list."""
+    counts = {} # class name -> [nodes, measured nodes, measured bytes]
+    seen = set() # shared leaves
+    stack = [statements]
+    while stack:
+        for node in stack.pop():
+            if node.shared:
+                if id(node) in seen:
+                    continue
+                seen.add(id(node))
+            name = type(node).__name__
+            count = counts.get(name)
+            if count is None:
+                count = counts[name] = [0, 0, 0]
+            if count[0] % sample == 0:
+                count[1] += 1
+                count[2] += node_size(node)
+            count[0] += 1
+            stack.extend(children(node))
+    return dict((name, [nodes, measured_bytes * nodes // measured])
+                for name, (nodes, measured, measured_bytes) in counts.items())
+
+def parser_report(model):
+    """What the textX parser behind model still holds, if anything.
+    Chunked models (parse.model_from_str) don't keep their parsers."""
+    parser = getattr(model, '_tx_parser', None)
+    if parser is None:
+        return {'retained': False}
+    nodes = 0
+    tree = getattr(parser, 'parse_tree', None)
+    stack = [[tree]] if tree is not None else []
+    while stack:
+        for node in stack.pop():
+            nodes += 1
+            if isinstance(node, list):
+                stack.append(node)
+    return {'retained': True, 'parse_tree_nodes': nodes,
+            'input_bytes': sys.getsizeof(getattr(parser, 'input', ''))}
+
+# interpreter attributes that aren't emitter buffers
+interpreter_state = frozenset([
+    'statement_stream', 'cursor', 'consumed', 'param_stack',
+    'environment_stack', 'environment_definitions', 'command_definitions',
+    'dispatch', 'out', 'file_name', 'current_command', 'mismatches'])
+
+def interpreter_report(interpreter):
+    frames = interpreter.statement_stream
+    buffers = {}
+    out = getattr(interpreter, 'out', None)
+    if isinstance(out, io.StringIO):
+        buffers['out'] = out.tell()
+    for name, value in vars(interpreter).items():
+        if name not in interpreter_state and isinstance(
+                value, (list, dict, set, str, bytes)):
+            buffers[name] = len(value)
+    return {
+        'depth': len(frames),
+        'peak_depth': interpreter.peak_depth,
+        'frame_statements': sum(len(frame) for frame in frames),
+        'frame_bytes': sum(sys.getsizeof(frame) for frame in frames),
+        'pushed_blocks': interpreter.pushed_blocks,
+        'pushed_statements': interpreter.pushed_statements,
+        'largest_block': interpreter.largest_block,
+        'expansions': interpreter.expansions,
+        'environments': len(interpreter.environment_stack),
+        'commands': len(interpreter.command_definitions),
+        'buffers': buffers,
+        }
+
+def state_nodes(state):
+    """Model nodes held by a package state dict (stored parameters)."""
+    blocks = list(value for value in state.values()
+                  if isinstance(value, parse.Block))
+    return sum(nodes for nodes, size in model_report(blocks).values())
+
+def package_report():
+    report = {}
+    for name in ['vgtc_state', 'article_state']:
+        state = getattr(pkgs, name)
+        report[name] = {'entries': len(state), 'nodes': state_nodes(state)}
+    listings = pkgs.graphics_index.listings
+    report['graphics_index'] = {
+        'directories': len(listings),
+        'names': sum(len(listing) for listing in listings.values())}
+    report['bibtex'] = {
+        'files': len(bibtex.indices),
+        'keys': sum(len(index.spans) for index in bibtex.indices.values()),
+        'parsed_entries': sum(len(index.entries)
+                              for index in bibtex.indices.values())}
+    return report
+
+def report(model=None, interpreter=None, sample=1):
+    """Everything above that applies, as a JSON-friendly dict."""
+    result = {}
+    if model is not None:
+        result['model'] = model_report(model.statements, sample)
+        result['parser'] = parser_report(model)
+    if interpreter is not None:
+        result['interpreter'] = interpreter_report(interpreter)
+    result['packages'] = package_report()
+    return result
+
+def format_report(report):
+    lines = []
+    model = report.get('model')
+    if model is not None:
+        lines.append("model:")
+        for name, (nodes, size) in sorted(
+                model.items(), key=lambda item: -item[1][1]):
+            lines.append("  %-16s %8d nodes %10.1f KB" % (name, nodes, size / 1e3))
+        nodes = sum(nodes for nodes, size in model.values())
+        size = sum(size for nodes, size in model.values())
+        lines.append("  %-16s %8d nodes %10.1f KB" % ("total", nodes, size / 1e3))
+    for section in ['parser', 'interpreter', 'packages']:
+        if section in report:
+            lines.append("%s:" % section)
+            for key, value in report[section].items():
+                lines.append("  %s: %s" % (key, value))
+    return "\n".join(lines)
@@ -1,4 +1,10 @@
-from textx import metamodel_from_file, get_children_of_type
+from textx import metamodel_from_str, get_children_of_type
+from textx.exceptions import TextXSyntaxError
+import itertools
+import os
+import re
+import sys
+import time
 
 ##############################################################################
 # The 'interpreter' will emit abstract commands, which we can then convert
@@ -10,11 +16,82 @@ from textx import metamodel_from_file, get_children_of_type
 class InterpreterRuntimeError(Exception):
     pass
 
+class ExpansionLimitError(InterpreterRuntimeError):
+    pass
+
+class BudgetExceeded(InterpreterRuntimeError):
+    """A run went over one of its budgets ('steps', 'seconds' or
+    'output'). Says how far it got, and which command it was in."""
+
+    def __init__(self, budget, limit, steps, seconds, output_size,
+                 command, file_name, position):
+        self.budget = budget
+        self.limit = limit
+        self.steps = steps
+        self.seconds = seconds
+        self.output_size = output_size
+        self.command = command
+        self.file_name = file_name
+        self.position = position
+        self.line, self.column = source_location(file_name, position)
+        where = ""
+        if command is not None:
+            where = " in %s" % command
+            if self.line is not None:
+                where += " (%s:%d:%d)" % (file_name, self.line, self.column)
+            elif position is not None:
+                where += " (offset %d)" % position
+        super().__init__(
+            "%s budget of %s exceeded after %d steps, %.2fs and %d characters "
+            "of output%s" % (budget, limit, steps, seconds, output_size, where))
+
+def source_location(file_name, position):
+    """(line, column), both from 1, of an offset into file_name, or
+    (None, None) if there is no file to look at."""
+    if file_name is None or position is None:
+        return None, None
+    try:
+        with open(file_name, encoding='utf-8') as f:
+            text = f.read(position)
+    except OSError:
+        return None, None
+    return line_column(text, position)
+
+def line_column(text, position):
+    line = text.count('\n', 0, position) + 1
+    return line, position - (text.rfind('\n', 0, position) + 1) + 1
+
+##############################################################################
+# statement kinds
+#
+# Every model class carries a small integer kind, and the interpreter
+# reports its events with the same integers, so emitters can dispatch
+# by indexing a table instead of comparing strings.
+
+KIND_NAMES = [
+    'comment', 'mathtoggle', 'linebreak', 'whitespace', 'block', 'number',
+    'word', 'parameter_use', 'punctuation', 'command', 'nop', 'echo',
+    'callback', 'begin_environment', 'end_environment', 'math']
+
+(KIND_COMMENT, KIND_MATHTOGGLE, KIND_LINEBREAK, KIND_WHITESPACE, KIND_BLOCK,
+ KIND_NUMBER, KIND_WORD, KIND_PARAMETER_USE, KIND_PUNCTUATION, KIND_COMMAND,
+ KIND_NOP, KIND_ECHO, KIND_CALLBACK, KIND_BEGIN_ENVIRONMENT,
+ KIND_END_ENVIRONMENT, KIND_MATH) = range(len(KIND_NAMES))
+
+def dispatch_table(handlers, default):
+    """Turns a {kind: handler} dict into a list indexed by kind.
+    Kinds without a handler get default(kind)."""
+    return list(handlers[kind] if kind in handlers else default(kind)
+                for kind in range(len(KIND_NAMES)))
+
 ##############################################################################
 # textx model classes
 
 class ModelClass:
 
+    # set on the canonical nodes of share_leaves (see below)
+    shared = False
+
     def as_string(self):
         lst = []
         self.collect_strings(lst)
@@ -22,6 +99,8 @@ class ModelClass:
 
 class LaTeXComment(ModelClass):
 
+    kind = KIND_COMMENT
+
     def __init__(self, parent=None, comment=None):
         self.parent = parent
         self.comment = comment
@@ -33,11 +112,13 @@ class LaTeXComment(ModelClass):
         pass
 
     def interpret(self, interpreter):
-        interpreter._process('comment', self.comment)
+        interpreter._process(KIND_COMMENT, self.comment)
     
     
 class MathToggle(ModelClass):
 
+    kind = KIND_MATHTOGGLE
+
     def __init__(self, parent=None, mt=None):
         self.parent = parent
         assert(mt == '$')
@@ -50,11 +131,34 @@ class MathToggle(ModelClass):
         lst.append("$")
 
     def interpret(self, interpreter):
-        interpreter._process('mathtoggle')
+        interpreter._process(KIND_MATHTOGGLE)
+
+
+# Math is matched whole by the lexer and never interpreted: emitters get
+# the raw source and pass it on to MathJax/KaTeX.
+
+class MathSpan(ModelClass):
+
+    kind = KIND_MATH
+
+    def __init__(self, parent=None, math=None):
+        self.parent = parent
+        self.math = math
+
+    def collect_strings(self, lst):
+        lst.append(self.math)
+
+    def interpret(self, interpreter):
+        interpreter._process(KIND_MATH, self.math)
+
+    def __repr__(self):
+        return "<MathSpan '%s' at 0x%x>" % (self.math, id(self))
 
 
 class LineBreak(ModelClass):
 
+    kind = KIND_LINEBREAK
+
     def __init__(self, parent=None, lb=None):
         self.parent = parent
         self.lb = lb
@@ -66,11 +170,13 @@ class LineBreak(ModelClass):
         lst.append("\n")
 
     def interpret(self, interpreter):
-        interpreter._process('linebreak')
+        interpreter._process(KIND_LINEBREAK)
 
     
 class Whitespace(ModelClass):
 
+    kind = KIND_WHITESPACE
+
     def __init__(self, parent=None, ws=None):
         self.parent = parent
         self.ws = ws
@@ -82,11 +188,16 @@ class Whitespace(ModelClass):
         lst.append(" ")
 
     def interpret(self, interpreter):
-        interpreter._process('whitespace')
+        interpreter._process(KIND_WHITESPACE)
 
 
 class Block(ModelClass):
 
+    kind = KIND_BLOCK
+
+    # False for a LazyBlock whose contents haven't been parsed yet
+    parsed = True
+
     def __init__(self, parent=None, statements=[]):
         self.parent = parent
         self.statements = statements
@@ -94,21 +205,31 @@ class Block(ModelClass):
     def interpret(self, interpreter):
         parameters = interpreter.param_stack[-1]
         interpreter.push_block(self.statements, parameters)
-        interpreter._process('block', self.statements)
+        interpreter._process(KIND_BLOCK, self.statements)
 
     # This will probably break when whitespace gets involved. shrug
     def collect_strings(self, lst):
-        for statement in self.statements:
-            statement.collect_strings(lst)
+        # with an explicit stack, so deep nesting can't hit the recursion limit
+        stack = [iter(self.statements)]
+        while stack:
+            for statement in stack[-1]:
+                if statement.kind == KIND_BLOCK:
+                    stack.append(iter(statement.statements))
+                    break
+                statement.collect_strings(lst)
+            else:
+                stack.pop()
         
 class Number(ModelClass):
 
+    kind = KIND_NUMBER
+
     def __init__(self, parent=None, number=[]):
         self.parent = parent
         self.number = number
 
     def interpret(self, interpreter):
-        interpreter._process('number', self.number)
+        interpreter._process(KIND_NUMBER, self.number)
 
     def __repr__(self):
         return "<Number '%s' at 0x%x>" % (self.number, id(self))
@@ -119,12 +240,14 @@ class Number(ModelClass):
         
 class Word(ModelClass):
 
+    kind = KIND_WORD
+
     def __init__(self, parent=None, word=None):
         self.parent = parent
         self.word = word
 
     def interpret(self, interpreter):
-        interpreter._process('word', self.word)
+        interpreter._process(KIND_WORD, self.word)
 
     def __repr__(self):
         return "<Word '%s' at 0x%x>" % (self.word, id(self))
@@ -134,6 +257,8 @@ class Word(ModelClass):
     
 class ParameterUse(ModelClass):
 
+    kind = KIND_PARAMETER_USE
+
     def __init__(self, parent=None, parameter_number=None):
         self.parent = parent
         self.parameter_number = parameter_number
@@ -142,7 +267,7 @@ class ParameterUse(ModelClass):
         parameters = interpreter.param_stack[-1]
         parameter_block = parameters[self.parameter_number-1]
         interpreter.push_block(parameter_block.statements, parameters)
-        interpreter._process('parameter_use', self.parameter_number)
+        interpreter._process(KIND_PARAMETER_USE, self.parameter_number)
 
     def __repr__(self):
         return "<ParameterUse '%s' at 0x%x>" % (self.parameter_number, id(self))
@@ -153,12 +278,17 @@ class ParameterUse(ModelClass):
     
 class Punctuation(ModelClass):
 
+    kind = KIND_PUNCTUATION
+
+    # for a '[', the offset of the ']' that ends it (see index_statements)
+    close_offset = None
+
     def __init__(self, parent=None, punctuation=None):
         self.parent = parent
         self.punctuation = punctuation
 
     def interpret(self, interpreter):
-        interpreter._process('punctuation', self.punctuation)
+        interpreter._process(KIND_PUNCTUATION, self.punctuation)
 
     def __repr__(self):
         return "<Punctuation '%s' at 0x%x>" % (self.punctuation, id(self))
@@ -169,18 +299,43 @@ class Punctuation(ModelClass):
         
 class Command(ModelClass):
 
+    kind = KIND_COMMAND
+
+    # filled in by index_statements for commands that open or continue
+    # a conditional region, and for \begin (see below)
+    else_offset = None
+    fi_offset = None
+    end_offset = None
+
+    # filled in by bind (see bind_commands below)
+    definition = None
+    bound_version = None
+
     def __init__(self, parent=None, command=None, optional_parameters=[]):
         self.parent = parent
         self.command = command
         self.optional_parameters = optional_parameters
 
+    def bind(self, definitions):
+        self.definition = definitions.get(self.command[1:])
+        self.bound_version = definitions.version
+        return self.definition
+
     def interpret(self, interpreter):
-        command_defn = interpreter.command_definitions[self.command[1:]]
+        interpreter.current_command = self
+        interpreter.current_position = interpreter.consumed[-1] - 1
+        definitions = interpreter.command_definitions
+        if self.bound_version != definitions.version:
+            self.bind(definitions)
+        command_defn = self.definition
+        if command_defn is None:
+            raise InterpreterRuntimeError("Undefined command %s" % self.command)
         optional_parameters = interpreter.read_optional_parameters()
-        self.optional_parameters = self.optional_parameters + optional_parameters
+        if self.optional_parameters:
+            optional_parameters = self.optional_parameters + optional_parameters
         parameters = interpreter.read_parameters(command_defn.params)
         
-        command_defn.invoke(interpreter, self.optional_parameters, parameters)
+        command_defn.invoke(interpreter, optional_parameters, parameters)
 
     def __repr__(self):
         return "<Command '%s' at 0x%x>" % (self.command, id(self))
@@ -188,11 +343,247 @@ class Command(ModelClass):
     def collect_strings(self, lst):
         lst.append(self.command)
 
-        
+
+##############################################################################
+# matching regions
+#
+# Right after parsing, every statement list gets a single pass that
+# matches \if.../\else/\fi (with nesting), \begin{X} with its \end{X},
+# and each '[' with the ']' that would end it as an optional argument
+# (the first one after it: like LaTeX, optional arguments don't nest).
+# The offsets are stored on the opening nodes and are relative, so they
+# stay valid in the copies the interpreter pushes. Skipped regions are
+# then never interpreted at all, and optional arguments are taken in
+# one slice. Nothing inside a comment environment counts.
+#
+# Mismatches are only reported for the document's own statement list:
+# a macro body may well open an environment that another one closes.
+
+def is_conditional(name):
+    return name.startswith('if') and name != 'ifthenelse'
+
+def environment_name(statements, ix):
+    """Returns X for a \\begin{X} or \\end{X} at statements[ix], or None."""
+    if ix + 1 >= len(statements):
+        return None
+    block = statements[ix + 1]
+    if block.kind != KIND_BLOCK or not block.parsed or len(block.statements) != 1:
+        return None
+    word = block.statements[0]
+    if word.kind != KIND_WORD:
+        return None
+    return word.word
+
+def clear_offset(statement, name):
+    vars(statement).pop(name, None)
+
+def clear_offsets(statement):
+    # a node reused from an earlier parse (see model_from_str's cache)
+    # still has the offsets that parse matched it with
+    if statement.kind == KIND_COMMAND:
+        clear_offset(statement, 'else_offset')
+        clear_offset(statement, 'fi_offset')
+        clear_offset(statement, 'end_offset')
+    elif statement.kind == KIND_PUNCTUATION and statement.punctuation == '[':
+        clear_offset(statement, 'close_offset')
+
+def index_statements(statements):
+    """Stores the offsets on the statements, and returns the mismatches
+    as a list of (position, message)."""
+    mismatches = []
+    open_conditionals = [] # [opener index, else index]
+    open_environments = [] # (name, opener index)
+    open_brackets = []
+    open_comment = None
+    for statement in statements:
+        clear_offsets(statement)
+    for ix, statement in enumerate(statements):
+        kind = statement.kind
+        if kind == KIND_PUNCTUATION and open_comment is None:
+            if statement.punctuation == '[':
+                open_brackets.append(ix)
+            elif statement.punctuation == ']':
+                for opener in open_brackets:
+                    statements[opener].close_offset = ix - opener
+                open_brackets = []
+            continue
+        if kind != KIND_COMMAND:
+            continue
+        name = statement.command[1:]
+        if open_comment is not None:
+            # comment environments don't nest, and nothing inside counts
+            if name == 'end' and environment_name(statements, ix) == 'comment':
+                statements[open_comment].end_offset = ix - open_comment
+                open_comment = None
+        elif name == 'begin':
+            environment = environment_name(statements, ix)
+            if environment == 'comment':
+                open_comment = ix
+            elif environment is not None:
+                open_environments.append((environment, ix))
+        elif name == 'end':
+            environment = environment_name(statements, ix)
+            if environment is None:
+                continue
+            for depth in range(len(open_environments) - 1, -1, -1):
+                if open_environments[depth][0] == environment:
+                    break
+            else:
+                mismatches.append((statement._tx_position,
+                                   "\\end{%s} without a \\begin" % environment))
+                continue
+            for other, opener in open_environments[depth + 1:]:
+                mismatches.append((statements[opener]._tx_position,
+                                   "\\begin{%s} ended by \\end{%s}" % (other, environment)))
+            opener = open_environments[depth][1]
+            statement = statements[opener]
+            statement.end_offset = ix - opener
+            del open_environments[depth:]
+        elif is_conditional(name):
+            open_conditionals.append([ix, None])
+        elif name == 'else' and open_conditionals:
+            opener = open_conditionals[-1]
+            if opener[1] is None:
+                opener[1] = ix
+                statements[opener[0]].else_offset = ix - opener[0]
+        elif name == 'fi' and open_conditionals:
+            opener_ix, else_ix = open_conditionals.pop()
+            statements[opener_ix].fi_offset = ix - opener_ix
+            if else_ix is not None:
+                statements[else_ix].fi_offset = ix - else_ix
+    for opener in open_brackets:
+        if opener > 0 and statements[opener - 1].kind in (KIND_COMMAND, KIND_BLOCK):
+            mismatches.append((statements[opener]._tx_position,
+                               "'[' of an optional argument without a ']'"))
+    for environment, opener in open_environments:
+        mismatches.append((statements[opener]._tx_position,
+                           "\\begin{%s} without an \\end" % environment))
+    if open_comment is not None:
+        mismatches.append((statements[open_comment]._tx_position,
+                           "\\begin{comment} without an \\end"))
+    for opener_ix, else_ix in open_conditionals:
+        # an \else without a \fi doesn't end anything either
+        clear_offset(statements[opener_ix], 'else_offset')
+    mismatches.sort()
+    return mismatches
+
+# (object processors must return None, or they replace the object)
+
+def index_block(block):
+    index_statements(block.statements)
+
+def index_model(model):
+    model.mismatches = index_statements(model.statements)
+
+##############################################################################
+# command binding
+#
+# Command nodes look their definition up once and keep it, along with
+# the version of the command_definitions they found it in. Any change
+# to the definitions gets a new version (unique across interpreters, as
+# models can be shared), so a node only looks up again after a
+# (re)definition. The binding pass before a run does all the lookups up
+# front, and collects the commands that have no definition at all.
+
+command_versions = itertools.count(1)
+
+class CommandDefinitions(dict):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = next(command_versions)
+
+    def __setitem__(self, name, definition):
+        super().__setitem__(name, definition)
+        self.version = next(command_versions)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.version = next(command_versions)
+
+    def pop(self, *args):
+        self.version = next(command_versions)
+        return super().pop(*args)
+
+    def setdefault(self, name, definition=None):
+        self.version = next(command_versions)
+        return super().setdefault(name, definition)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version = next(command_versions)
+
+    def clear(self):
+        super().clear()
+        self.version = next(command_versions)
+
+def bind_commands(statements, definitions):
+    """Binds every Command under statements that the interpreter could
+    reach; optional parameters and regions that are always skipped
+    (\\iffalse, \\ifpdf, comment environments) are left out. Returns
+    {name: occurrences} of the commands without a definition, other
+    than those the document defines itself with \\renewcommand*."""
+    unknown = {}
+    defined = set()
+    stack = [statements]
+    while stack:
+        statements = stack.pop()
+        ix = 0
+        while ix < len(statements):
+            statement = statements[ix]
+            ix += 1
+            if statement.kind == KIND_BLOCK:
+                # commands in a lazy block are bound if it's ever parsed,
+                # but one with an unknown command is parsed now
+                if statement.parsed or any(
+                        name not in definitions for name in statement.command_names()):
+                    stack.append(statement.statements)
+                continue
+            if statement.kind != KIND_COMMAND:
+                continue
+            definition = statement.bind(definitions)
+            if definition is None:
+                name = statement.command[1:]
+                unknown[name] = unknown.get(name, 0) + 1
+                continue
+            if isinstance(definition, IfFalse) and statement.fi_offset is not None:
+                ix += (statement.else_offset or statement.fi_offset) - 1
+                continue
+            if isinstance(definition, StartIgnoring) and statement.fi_offset is not None:
+                ix += statement.fi_offset - 1
+                continue
+            if (isinstance(definition, BeginCommand) and statement.end_offset is not None
+                and environment_name(statements, ix - 1) == 'comment'):
+                ix += statement.end_offset - 1
+                continue
+            # optional parameters are read as plain tokens, never interpreted
+            if (ix < len(statements) and statements[ix].kind == KIND_PUNCTUATION
+                and statements[ix].punctuation == '['):
+                if statements[ix].close_offset is not None:
+                    ix += statements[ix].close_offset + 1
+                else:
+                    ix = len(statements)
+            if isinstance(definition, RenewCommandStar) and ix < len(statements):
+                # the name, braced or not, is read rather than interpreted
+                defined.add(statements[ix].as_string().lstrip('\\'))
+                ix += 1
+                continue
+            # and only macros get to interpret their parameters; the other
+            # commands take them as data (\author, \begin, \graphicspath)
+            if not isinstance(definition, LaTeXCommand):
+                for i in range(getattr(definition, 'params', 0)):
+                    if ix < len(statements) and statements[ix].kind == KIND_BLOCK:
+                        ix += 1
+    for name in defined:
+        unknown.pop(name, None)
+    return unknown
+
 # we use a NOP as a sentinel in the cursor code to simplify it
 
 class NOPModel(ModelClass):
 
+    kind = KIND_NOP
+
     def __init__(self):
         pass
 
@@ -208,6 +599,8 @@ class NOPModel(ModelClass):
 
 class Echo(ModelClass):
 
+    kind = KIND_ECHO
+
     def __init__(self, value):
         self.value = value
 
@@ -215,10 +608,12 @@ class Echo(ModelClass):
         lst.append(self.value)
 
     def interpret(self, interpreter, *args):
-        EchoCommand(self.value).invoke(interpreter, [], [])
+        interpreter._process(KIND_ECHO, self.value)
 
 class Callback(ModelClass):
 
+    kind = KIND_CALLBACK
+
     def __init__(self, value):
         self.value = value
 
@@ -226,7 +621,7 @@ class Callback(ModelClass):
         pass
 
     def interpret(self, interpreter, *args):
-        CallbackCommand(self.value).invoke(interpreter, [], [])
+        interpreter._process(KIND_CALLBACK, self.value)
 
 ##############################################################################
 # interpreter classes
@@ -253,7 +648,7 @@ class EchoCommand(InterpreterCommand):
         self.value = value
     
     def invoke(self, interpreter, *args):
-        interpreter._process('echo', self.value)
+        interpreter._process(KIND_ECHO, self.value)
 
 class CallbackCommand(InterpreterCommand):
 
@@ -262,7 +657,7 @@ class CallbackCommand(InterpreterCommand):
         self.value = value
 
     def invoke(self, interpreter, *args):
-        interpreter._process('callback', self.value)
+        interpreter._process(KIND_CALLBACK, self.value)
 
 
 class LaTeXCommand(InterpreterCommand):
@@ -277,8 +672,9 @@ class LaTeXCommand(InterpreterCommand):
             raise InterpreterRuntimeError(
                 "Command %s: Expected %d parameters, got %d instead" % (
                     self.name, self.params, len(parameters)))
+        interpreter.count_expansion(self.name)
         interpreter.push_block(self.block.statements, parameters)
-        interpreter._process('command', self.name, parameters, optional_params)
+        interpreter._process(KIND_COMMAND, self.name, parameters, optional_params)
 
         
 class BeginCommand(InterpreterCommand):
@@ -289,30 +685,29 @@ class BeginCommand(InterpreterCommand):
     def invoke(self, interpreter, optional_params, parameters):
         assert len(parameters) == 1
         name_block = parameters[0]
-        assert isinstance(name_block, Block)
+        assert name_block.kind == KIND_BLOCK
         if len(name_block.statements) != 1:
             raise InterpreterRuntimeError("Begin environment should have a single name")
         name_stmt = name_block.statements[0]
-        if not isinstance(name_stmt, Word):
+        if name_stmt.kind != KIND_WORD:
             raise InterpreterRuntimeError("Begin environment's name should be a word")
         name = name_stmt.word
+        if name == 'comment':
+            command = interpreter.current_command
+            if (command.end_offset is None or
+                not interpreter.skip_ahead(command.end_offset + 2)):
+                raise InterpreterRuntimeError(
+                    "comment environment should end in the same block")
+            return
         environment = interpreter.environment_definitions[name]
         parameters = interpreter.read_parameters(environment.params)
 
         # optional parameters for environments show up in reverse order and are inside
         # a context-dependent bit, so we need to parse them here, sigh
         tok = interpreter.peek()
-        if tok.as_string() == '[':
+        if tok.kind == KIND_PUNCTUATION and tok.punctuation == '[':
             # this will fail in general, but we'll greedily assume these are optional parameters now
-            interpreter.read()
-            optional_params_list = []
-            tok = interpreter.peek()
-            while tok.as_string() != ']':
-                tok_to_add = interpreter.read()
-                optional_params_list.append(tok_to_add)
-                tok = interpreter.peek()
-            interpreter.read()
-            optional_params = Block(statements=optional_params_list)
+            optional_params = interpreter.read_bracketed()
 
         interpreter.push_environment(name)
         if environment.params > 0:
@@ -320,7 +715,7 @@ class BeginCommand(InterpreterCommand):
             interpreter.push_block(environment.preamble, parameters)
         else:
             interpreter.push_block(environment.preamble, interpreter.param_stack[-1])
-        interpreter._process('begin_environment', name, optional_params, parameters)
+        interpreter._process(KIND_BEGIN_ENVIRONMENT, name, optional_params, parameters)
 
             
 class EndCommand(InterpreterCommand):
@@ -331,11 +726,11 @@ class EndCommand(InterpreterCommand):
     def invoke(self, interpreter, optional_params, parameters):
         assert len(parameters) == 1
         name_block = parameters[0]
-        assert isinstance(name_block, Block)
+        assert name_block.kind == KIND_BLOCK
         if len(name_block.statements) != 1:
             raise InterpreterRuntimeError("End environment should have a single name")
         name_stmt = name_block.statements[0]
-        if not isinstance(name_stmt, Word):
+        if name_stmt.kind != KIND_WORD:
             raise InterpreterRuntimeError("End environment's name should be a word")
         name = name_stmt.word
         environment = interpreter.environment_definitions[name]
@@ -345,7 +740,7 @@ class EndCommand(InterpreterCommand):
             interpreter.push_block(environment.postamble, parameters)
         else:
             interpreter.push_block(environment.postamble, interpreter.param_stack[-1])
-        interpreter._process('end_environment', name, parameters)
+        interpreter._process(KIND_END_ENVIRONMENT, name, parameters)
         interpreter.pop_environment()
 
 class NOP(InterpreterCommand):
@@ -353,10 +748,38 @@ class NOP(InterpreterCommand):
     def invoke(self, *args):
         pass
 
+# \ifpdf and friends: we ignore both branches. Without a matching \fi
+# in the same block we fall back to suppressing output until one shows up.
 class StartIgnoring(InterpreterCommand):
 
     def invoke(self, interpreter, *args):
-        interpreter.halt_processing()
+        command = interpreter.current_command
+        if (command.fi_offset is None or
+            not interpreter.skip_ahead(command.fi_offset)):
+            interpreter.halt_processing()
+
+
+class IfFalse(InterpreterCommand):
+
+    def invoke(self, interpreter, *args):
+        command = interpreter.current_command
+        if command.else_offset is not None:
+            skipped = interpreter.skip_ahead(command.else_offset + 1)
+        elif command.fi_offset is not None:
+            skipped = interpreter.skip_ahead(command.fi_offset)
+        else:
+            skipped = False
+        if not skipped:
+            interpreter.halt_processing()
+
+
+# reached only when the branch before it was taken
+class Else(InterpreterCommand):
+
+    def invoke(self, interpreter, *args):
+        command = interpreter.current_command
+        if interpreter.processing and command.fi_offset is not None:
+            interpreter.skip_ahead(command.fi_offset)
 
 
 class StopIgnoring(InterpreterCommand):
@@ -372,14 +795,15 @@ class RenewCommandStar(InterpreterCommand):
         command_block = interpreter.read()
         params = 0
         if len(optional_parameters):
-            v = optional_parameters[0].as_string
+            v = optional_parameters[0].as_string()
             try:
                 n = int(v)
             except ValueError:
                 raise InterpreterRuntimeError("expected optional parameter %s to be a number" % v)
             params = n
+        # \renewcommand*{\foo}: commands are stored without the backslash
         interpreter.new_command(
-            command_name.as_string(), params,
+            command_name.as_string().lstrip('\\'), params,
             command_block)
 
 def echo(value):
@@ -401,19 +825,52 @@ class EnvironmentRecord:
         for hook in self.pop_hooks:
             hook()
 
+# A self-referential macro keeps pushing frames (or, if it doesn't nest,
+# keeps expanding), so both are bounded.
+MAX_DEPTH = 10000
+MAX_EXPANSIONS = 1000000
+
+# Budgets (steps, seconds, output characters; None for no limit). The
+# step and time budgets are only looked at every this many steps, so the
+# step loop pays a single integer comparison for them. A single step can
+# write a lot (a bibliography, say), so output is checked as it's
+# written (see add_output).
+BUDGET_CHECK_INTERVAL = 1024
+
 class Interpreter:
     
-    def __init__(self, model):
+    def __init__(self, model, max_depth=MAX_DEPTH, max_expansions=MAX_EXPANSIONS,
+                 max_steps=None, max_seconds=None, max_output=None):
+        self.file_name = getattr(model, '_tx_filename', None)
+        self.max_depth = max_depth
+        self.max_expansions = max_expansions
+        self.expansions = 0
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_output = max_output
+        self.steps = 0
+        self.output_size = 0 # emitters add what they write (add_output)
+        self.started = None
+        self.next_check = 0
+        # for memory.interpreter_report
+        self.peak_depth = 1
+        self.pushed_blocks = 0
+        self.pushed_statements = 0
+        self.largest_block = 0
         self.statement_stream = [model.statements + [NOPModel()]]
         self.processing = True
         self.cursor = [0]
         self.consumed = [0]
         self.param_stack = [[]]
         self.consumed_token = False
+        self.current_command = None
+        self.current_position = 0
 
         self.environment_stack = []
         self.environment_definitions = {}
-        self.command_definitions = {}
+        self.command_definitions = CommandDefinitions()
+        self.unknown_commands = {}
+        self.mismatches = getattr(model, 'mismatches', [])
         self.create_initial_state()
 
     ##########################################################################
@@ -448,6 +905,18 @@ class Interpreter:
             if len(self.cursor):
                 self.cursor[-1] = self.consumed[-1]
 
+    def skip_ahead(self, offset):
+        """Moves the cursor to offset statements past the command being
+        invoked, without interpreting anything in between. Returns False
+        (and does nothing) if that command isn't in the current block."""
+        stream = self.statement_stream[-1]
+        position = self.current_position
+        if (position < 0 or position + offset >= len(stream) or
+            stream[position] is not self.current_command):
+            return False
+        self.consumed[-1] = position + offset
+        return True
+
     def stream_ended(self):
         return self.cursor == []
 
@@ -461,10 +930,29 @@ class Interpreter:
         assert isinstance(parameters, list)
         if isinstance(block, Block):
             block = block.statements
+        if len(self.statement_stream) >= self.max_depth:
+            command = self.current_command
+            raise ExpansionLimitError(
+                "Frame stack exceeded %d levels (at %s); runaway macro?" % (
+                    self.max_depth,
+                    command.command if command is not None else 'the top level'))
         self.statement_stream.append(block + [NOPModel()])
         self.cursor.append(0)
         self.consumed.append(0)
         self.param_stack.append(parameters)
+        self.pushed_blocks += 1
+        self.pushed_statements += len(block)
+        if len(block) > self.largest_block:
+            self.largest_block = len(block)
+        if len(self.statement_stream) > self.peak_depth:
+            self.peak_depth = len(self.statement_stream)
+
+    def count_expansion(self, name):
+        self.expansions += 1
+        if self.expansions > self.max_expansions:
+            raise ExpansionLimitError(
+                "More than %d macro expansions (at \\%s); runaway macro?" % (
+                    self.max_expansions, name))
 
     ##########################################################################
     # Environment management
@@ -512,7 +1000,6 @@ class Interpreter:
         self.new_command('textbackslash', 0)
         self.new_command('\\', 0)
         self.new_command('dots', 0)
-        self.new_command('sum', 0)
         self.new_command('small', 0)
         self.new_command('scriptsize', 0)
         self.new_command('centering', 0)
@@ -525,7 +1012,6 @@ class Interpreter:
         self.new_command('texttt', 1)
         self.new_command('LaTeX', 0)
         self.new_command('TeX', 0)
-        self.new_command('frac', 2)
         self.new_command('rotatebox', 2)
         self.new_command('toprule', 0)
         self.new_command('midrule', 0)
@@ -536,6 +1022,7 @@ class Interpreter:
         
         self.new_command('href', 1)
         self.new_command('autoref', 1)
+        self.new_command('ref', 1)
         self.new_command('cite', 1)
         
         self.new_command('usepackage', 1)
@@ -558,7 +1045,9 @@ class Interpreter:
         self.command_definitions['end'] = EndCommand()
         
         self.command_definitions['ifpdf'] = StartIgnoring()
-        self.command_definitions['else'] = NOP()
+        self.command_definitions['iffalse'] = IfFalse()
+        self.command_definitions['iftrue'] = NOP()
+        self.command_definitions['else'] = Else()
         self.command_definitions['fi'] = StopIgnoring()
         for cmd in ['pdfoutput', 'pdfcompresslevel',
                     'pdfoptionpdfminorversion',
@@ -599,7 +1088,7 @@ class Interpreter:
         self.advance()
         result = []
         cmd = self.peek()
-        while n_max > 0 and isinstance(cmd, Block):
+        while n_max > 0 and cmd is not None and cmd.kind == KIND_BLOCK:
             result.append(cmd)
             self.consume()
             self.advance()
@@ -612,16 +1101,33 @@ class Interpreter:
         result = []
         self.advance()
         cmd = self.peek()
-        while cmd.as_string() == '[':
-            self.read()
-            block_list = []
+        while cmd.kind == KIND_PUNCTUATION and cmd.punctuation == '[':
+            result.append(self.read_bracketed())
             cmd = self.peek()
-            while cmd.as_string() != ']':
-                block_list.append(self.read())
-                cmd = self.peek()
-            result.append(Block(statements=block_list))
-            self.read()
         return result
+
+    def read_bracketed(self):
+        """Consumes the '[...]' that starts at the cursor, and returns
+        what is between the brackets as a Block."""
+        statements = self.statement_stream[-1]
+        ix = self.cursor[-1]
+        offset = statements[ix].close_offset
+        if offset is not None and ix + offset < len(statements):
+            close = statements[ix + offset]
+            if close.kind == KIND_PUNCTUATION and close.punctuation == ']':
+                self.consumed[-1] = ix + offset + 1
+                self.advance()
+                return Block(statements=statements[ix + 1:ix + offset])
+        # the ']' is past the end of this frame (or the frame wasn't
+        # indexed), so go token by token
+        self.read()
+        block_list = []
+        cmd = self.peek()
+        while cmd.kind != KIND_PUNCTUATION or cmd.punctuation != ']':
+            block_list.append(self.read())
+            cmd = self.peek()
+        self.read()
+        return Block(statements=block_list)
     
     # def begin_environment(self, name):
     #     environment = self.get_environment_definition(name)
@@ -646,23 +1152,98 @@ class Interpreter:
         """Advances one full statement from the stream"""
         statement = self.peek()
         try:
-            assert isinstance(statement, ModelClass)
-        except AssertionError:
+            statement.kind
+        except AttributeError:
             print("Unimplemented model class!", statement)
             raise
         self.consume()
         statement.interpret(self)
         self.advance()
 
+    def bind_commands(self):
+        """Binds the document's commands ahead of the run, and reports
+        the ones without a definition in one go."""
+        if not self.statement_stream:
+            return
+        self.unknown_commands = bind_commands(
+            self.statement_stream[0], self.command_definitions)
+        if self.unknown_commands:
+            print("Undefined commands:", ", ".join(
+                "\\%s (%d)" % (name, count)
+                for name, count in sorted(self.unknown_commands.items())),
+                  file=sys.stderr)
+
+    def report_mismatches(self):
+        """Prints the document's unmatched brackets and environments."""
+        if not self.mismatches:
+            return
+        text = None
+        if self.file_name is not None:
+            try:
+                with open(self.file_name, encoding='utf-8') as f:
+                    text = f.read()
+            except OSError:
+                pass
+        for position, message in self.mismatches:
+            if text is None:
+                where = "offset %d" % position
+            else:
+                where = "%s:%d:%d" % ((self.file_name,) + line_column(text, position))
+            print("%s: %s" % (where, message), file=sys.stderr)
+
+    def start_budgets(self):
+        self.started = time.perf_counter()
+        if self.max_steps is None and self.max_seconds is None:
+            self.next_check = float('inf')
+        else:
+            self.check_budgets()
+
+    def check_budgets(self):
+        """Raises BudgetExceeded if the run is over budget, and sets
+        the step count of the next check."""
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            self.exceeded('steps', self.max_steps)
+        if (self.max_seconds is not None and
+            time.perf_counter() - self.started > self.max_seconds):
+            self.exceeded('seconds', self.max_seconds)
+        self.next_check = self.steps + BUDGET_CHECK_INTERVAL
+        if self.max_steps is not None and self.max_steps < self.next_check:
+            self.next_check = self.max_steps
+
+    def add_output(self, size):
+        """Counts size characters of output, raising BudgetExceeded
+        before they would take the run over its output budget."""
+        self.output_size += size
+        if self.max_output is not None and self.output_size > self.max_output:
+            self.exceeded('output', self.max_output)
+
+    def exceeded(self, budget, limit):
+        command = self.current_command
+        # output can be written before the run starts (see eventlog.replay)
+        seconds = 0.0 if self.started is None else time.perf_counter() - self.started
+        raise BudgetExceeded(
+            budget, limit, self.steps, seconds,
+            self.output_size, command and command.command, self.file_name,
+            getattr(command, '_tx_position', None))
+
     def run(self):
+        self.bind_commands()
+        self.report_mismatches()
+        self.start_budgets()
+        self.run_steps()
+
+    def run_steps(self):
         while not self.stream_ended():
+            if self.steps >= self.next_check:
+                self.check_budgets()
             self.step()
+            self.steps += 1
 
     ##########################################################################
     # abstract statement processing; override this to add specific behavior
 
     def process(self, kind, *args):
-        print("process", kind, *args)
+        print("process", KIND_NAMES[kind], *args)
 
 ##############################################################################
 # package definition support
@@ -680,10 +1261,282 @@ def command_store_in_state(command_name, var, command_key=None):
     return Command()
 
 ##############################################################################
+# lazy blocks
+#
+# Plenty of block arguments are never looked at: \title and \abstract
+# go into package state that Markdown never emits, and parameters of
+# NOP commands and skipped regions are dropped. A {...} of at least
+# LAZY_BLOCK_SIZE characters is therefore matched by a single regex and
+# kept as a LazyBlock holding its source; its statements are parsed the
+# first time they're asked for. Each of those parses costs textX a fixed
+# ~0.7 ms, which is about what it takes to parse 16 characters, so
+# short blocks are parsed right away. So are blocks nested more than
+# LAZY_BLOCK_DEPTH deep, which the regex can't match. Passes over the
+# whole model (sharing, shifting) leave unparsed blocks alone. Binding
+# only looks inside the ones it would reach: their command names are
+# found with a regex, and a block is parsed (and walked) if any of them
+# has no definition, so undefined commands are still reported up front.
+
+LAZY_BLOCK_SIZE = 80
+LAZY_BLOCK_DEPTH = 4
+
+def lazy_block_pattern(size=LAZY_BLOCK_SIZE, depth=LAZY_BLOCK_DEPTH):
+    """A regex for a brace group with at least size items (characters,
+    escapes, comments or inner groups). Comments take their newline, so
+    no two alternatives start alike and the match never backtracks."""
+    item = r'[^{}\\%]|\\.|%[^\n]*\n'
+    group = r'\{(?:%s)*\}' % item
+    for i in range(depth - 2):
+        group = r'\{(?:%s|%s)*\}' % (item, group)
+    return r'(?s)\{(?:%s|%s){%d,}\}' % (item, group, size)
+
+def grammar_regex(rule):
+    with open("latex_grammar.txt") as f:
+        pattern = re.search(r'^%s: (?:\w+=)?/(.*)/(?: \S+)?;$' % rule,
+                            f.read(), re.MULTILINE).group(1)
+    return pattern.replace('(?s)', '')
+
+# math and comments first, as commands in them are never interpreted
+command_scanner = re.compile(r'(?s)%s|%s|%%[^\n]*' % (
+    grammar_regex('MathSpanContents'), grammar_regex('Command')))
+
+class LazyBlock(Block):
+
+    parsed = False
+    leaves = None # the share_leaves table of its parse, if it had one
+
+    def __init__(self, parent=None, text=None):
+        self.parent = parent
+        self.text = text
+
+    @property
+    def statements(self):
+        if not self.parsed:
+            self.parse()
+        return self.__dict__['statements']
+
+    @statements.setter
+    def statements(self, statements):
+        self.__dict__['statements'] = statements
+        self.parsed = True
+        self.text = None
+
+    def command_names(self):
+        """The names of the commands in the unparsed text."""
+        names = set()
+        last = command_scanner.groups # the Command regex's two groups
+        for match in command_scanner.finditer(self.text, 1, len(self.text) - 1):
+            command = match.group(last - 1) or match.group(last)
+            if command:
+                names.add(command[1:])
+        return names
+
+    def parse(self):
+        try:
+            statements = parse_text(self.text[1:-1], self._tx_position + 1).statements
+        except TextXSyntaxError as e:
+            raise InterpreterRuntimeError(
+                "Syntax error in the block at offset %d: %s" % (self._tx_position, e))
+        if self.leaves is not None:
+            share_leaves(statements, self.leaves)
+            del self.leaves
+        shift_positions(statements, self._tx_position + 1)
+        for statement in statements:
+            if not statement.shared:
+                statement.parent = self
+        self.statements = statements
+
+##############################################################################
+
+def make_grammar(lazy_block_size=LAZY_BLOCK_SIZE):
+    """The metamodel; with lazy_block_size None, no block is lazy."""
+    if lazy_block_size is None:
+        pattern = '(?!)'
+    else:
+        pattern = lazy_block_pattern(lazy_block_size)
+    with open("latex_grammar.txt") as f:
+        source = f.read().replace('LAZY_BLOCK_PATTERN', pattern)
+    result = metamodel_from_str(
+        source,
+        classes=[Command, Word, Number, ParameterUse, Punctuation, LaTeXComment,
+                 Block, LazyBlock, Whitespace, LineBreak, MathToggle, MathSpan],
+        skipws=False,
+        memoization=True)
+    result.register_obj_processors({
+        'File': index_model,
+        'Block': index_block,
+        })
+    return result
+
+grammar = make_grammar()
+
+##############################################################################
+# chunked parsing
+#
+# The packrat memo table grows with input size times the number of
+# rules. To bound it, we split the input after newlines outside any
+# braces and math (no token straddles those), parse each chunk
+# separately, and concatenate the statements into a single File. Memo
+# tables and parse trees are then only ever as large as one chunk.
+
+CHUNK_SIZE = 32768
+
+# math first, so that \( and \[ aren't taken for escapes
+chunk_scanner = re.compile(
+    r'(?s)%s|\\.|%%[^\n]*|\{|\}|\n' % grammar_regex('MathSpanContents'))
+
+def nesting_depth(text):
+    """The deepest brace nesting in text, and the offset it's reached at."""
+    depth = deepest = offset = 0
+    for match in chunk_scanner.finditer(text):
+        token = match.group()
+        if token == '{':
+            depth += 1
+            if depth > deepest:
+                deepest, offset = depth, match.start()
+        elif token == '}':
+            depth -= 1
+    return deepest, offset
+
+def parse_text(text, offset=0):
+    """grammar.model_from_str(text), for text at offset in the document.
+    The parser recurses for every level of braces, so deeply nested
+    input is an ExpansionLimitError rather than a RecursionError."""
+    try:
+        return grammar.model_from_str(text)
+    except RecursionError:
+        depth, deepest = nesting_depth(text)
+    raise ExpansionLimitError(
+        "Braces nested %d deep (at offset %d) are too deep to parse" % (
+            depth, offset + deepest))
+
+def split_chunks(text, chunk_size=CHUNK_SIZE):
+    """Yields (offset, chunk) pairs of at least chunk_size characters
+    (except the last), cut right after a newline at brace depth 0."""
+    start = 0
+    depth = 0
+    for match in chunk_scanner.finditer(text):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif token == '\n' and depth == 0:
+            end = match.end()
+            if end - start >= chunk_size:
+                yield start, text[start:end]
+                start = end
+    if start < len(text):
+        yield start, text[start:]
 
-grammar = metamodel_from_file(
-    "latex_grammar.txt",
-    classes=[Command, Word, Number, ParameterUse, Punctuation, LaTeXComment,
-             Block, Whitespace, LineBreak, MathToggle],
-    skipws=False,
-    memoization=True)
+##############################################################################
+# shared leaves
+#
+# Words, numbers, punctuation, whitespace and line breaks are nothing but
+# their text: the interpreter never looks at their parents or source
+# positions, and never changes them. So a paper's thousands of equal
+# ones can be a single node each. share_leaves swaps every such node for
+# the canonical one in leaves (a {kind: {text: node}} dict, shared by
+# the chunks of a parse), and interns command names. All whitespace and
+# all line breaks render the same, so each is one node whatever its
+# source text. Canonical nodes are marked shared and have no parent or
+# position. A '[' is never shared, since it carries its close_offset.
+
+SHARE_LEAVES = True
+
+# kind -> the attribute holding the text, or None if it doesn't matter
+leaf_texts = {
+    KIND_WORD: 'word', KIND_NUMBER: 'number', KIND_PUNCTUATION: 'punctuation',
+    KIND_WHITESPACE: None, KIND_LINEBREAK: None,
+    }
+
+leaf_renderings = {KIND_WHITESPACE: ' ', KIND_LINEBREAK: '\n'}
+
+def share_leaves(statements, leaves):
+    stack = [statements]
+    while stack:
+        statements = stack.pop()
+        for ix, node in enumerate(statements):
+            kind = node.kind
+            if kind == KIND_BLOCK:
+                if node.parsed:
+                    stack.append(node.statements)
+                else:
+                    node.leaves = leaves
+                continue
+            if kind == KIND_COMMAND:
+                node.command = sys.intern(node.command)
+                for optional in node.optional_parameters:
+                    stack.append(optional.statements)
+                continue
+            if kind not in leaf_texts or node.shared:
+                continue
+            attribute = leaf_texts[kind]
+            text = getattr(node, attribute) if attribute else leaf_renderings[kind]
+            if text == '[':
+                continue
+            nodes = leaves.get(kind)
+            if nodes is None:
+                nodes = leaves[kind] = {}
+            shared = nodes.get(text)
+            if shared is None:
+                shared = nodes[text] = type(node)(None, text)
+                shared.shared = True
+            statements[ix] = shared
+
+def shift_positions(statements, offset):
+    if offset == 0:
+        return
+    stack = [statements]
+    while stack:
+        for node in stack.pop():
+            if node.shared:
+                continue
+            node._tx_position += offset
+            node._tx_position_end += offset
+            if node.kind == KIND_BLOCK:
+                if node.parsed:
+                    stack.append(node.statements)
+            elif node.kind == KIND_COMMAND:
+                for optional in node.optional_parameters:
+                    stack.append(optional.statements)
+
+def model_from_str(text, chunk_size=CHUNK_SIZE, cache=None, share=SHARE_LEAVES):
+    """Parses text chunk by chunk. cache, if given, maps chunk text to a
+    list of (offset, statements) from an earlier call; chunks found there
+    are reused instead of parsed again, and it is updated to this parse.
+    With share, equal leaves are one node (see share_leaves)."""
+    model = grammar['File']()
+    model.statements = []
+    model._tx_filename = None
+    model._tx_metamodel = grammar
+    model._tx_position = 0
+    model._tx_position_end = len(text)
+    chunks = {}
+    leaves = {}
+    for offset, chunk in split_chunks(text, chunk_size):
+        if cache is not None and cache.get(chunk):
+            old_offset, statements = cache[chunk].pop()
+            shift_positions(statements, offset - old_offset)
+        else:
+            statements = parse_text(chunk, offset).statements
+            if share:
+                share_leaves(statements, leaves)
+            shift_positions(statements, offset)
+        chunks.setdefault(chunk, []).append((offset, statements))
+        for statement in statements:
+            if not statement.shared:
+                statement.parent = model
+        model.statements.extend(statements)
+    # conditionals and environments may span chunks
+    index_model(model)
+    if cache is not None:
+        cache.clear()
+        cache.update(chunks)
+    return model
+
+def model_from_file(file_name, chunk_size=CHUNK_SIZE, cache=None, share=SHARE_LEAVES):
+    with open(file_name, encoding='utf-8') as f:
+        model = model_from_str(f.read(), chunk_size, cache, share)
+    model._tx_filename = os.path.abspath(file_name)
+    return model
@@ -1,10 +1,19 @@
 from parse import command_store_in_state
+import os
 import parse
 
 ##############################################################################
 # graphics
+#
+# The \graphicspath is per document, so it is kept on the interpreter;
+# only the directory listings are shared by a batch.
 
-graphics_state = {}
+# in order of preference, as with \DeclareGraphicsExtensions; matched
+# without regard to case, as graphicx lists .PNG and .JPG too
+graphics_extensions = ['.pdf', '.png', '.jpg', '.jpeg', '.eps']
+
+# for emitters writing web pages, which can't show a PDF in an <img>
+web_graphics_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.svg', '.pdf', '.eps']
 
 class GraphicsPath:
 
@@ -12,11 +21,71 @@ class GraphicsPath:
         self.params = 1
 
     def invoke(self, interpreter, optionals, parameters):
-        graphics_state["graphics_path"] = list(
+        interpreter.graphics_path = list(
             stmt.as_string() for stmt in parameters[0].statements)
-        
+
+class GraphicsIndex:
+    """Lists each graphics directory once, and resolves \\includegraphics
+    names against the listings instead of stat-ing every candidate file.
+    Meant to be shared by all the documents of a batch run."""
+
+    def __init__(self):
+        self.listings = {} # directory -> {stem: [file names]}
+
+    def listing(self, directory):
+        directory = os.path.abspath(directory)
+        listing = self.listings.get(directory)
+        if listing is None:
+            listing = {}
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        stem, ext = os.path.splitext(entry.name)
+                        listing.setdefault(stem, []).append(entry.name)
+                        if ext:
+                            # names given with their extension
+                            listing.setdefault(entry.name, []).append(entry.name)
+            except OSError:
+                pass
+            self.listings[directory] = listing
+        return listing
+
+    def resolve(self, name, search_path, extensions=graphics_extensions):
+        """Returns the path of the file \\includegraphics{name} refers to,
+        trying each directory of search_path in order, and extensions in
+        order within each, or None."""
+        for directory in search_path:
+            path = os.path.join(directory, name)
+            candidates = self.listing(os.path.dirname(path)).get(
+                os.path.basename(path))
+            if not candidates:
+                continue
+            base = os.path.basename(path)
+            if base in candidates:
+                return path
+            for ext in extensions:
+                for candidate in candidates:
+                    if candidate[len(base):].lower() == ext:
+                        return os.path.join(os.path.dirname(path), candidate)
+        return None
+
+graphics_index = GraphicsIndex()
+
+def resolve_graphics(interpreter, name, extensions=graphics_extensions):
+    """Resolves an \\includegraphics argument relative to the document,
+    searching its directory first and then \\graphicspath."""
+    base_dir = os.path.dirname(interpreter.file_name) if interpreter.file_name else '.'
+    search_path = [base_dir] + list(
+        os.path.join(base_dir, directory)
+        for directory in getattr(interpreter, 'graphics_path', []))
+    path = graphics_index.resolve(name, search_path, extensions)
+    if path is None:
+        return None
+    return os.path.relpath(path, base_dir)
+
 
 def install_graphics_support(interpreter):
+    interpreter.graphics_path = []
     interpreter.command_definitions['graphicspath'] = GraphicsPath()
     interpreter.new_command('includegraphics', 1)
 
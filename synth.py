@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+
+##############################################################################
+# synthetic documents
+#
+# test-files/ tops out at about 25 KB, which hides anything that grows
+# faster than the input. generate() writes a document of about a given
+# size in one of a few shapes, always the same one for the same seed, so
+# the benchmarks can compare sizes run against run. Everything in it is
+# something the interpreter and MarkdownEmit know how to handle.
+
+syllables = ['ta', 'ren', 'lo', 'vi', 'sum', 'dor', 'mea', 'cu', 'pra',
+             'nis', 'el', 'gra', 'phi', 'tor', 'sa', 'mun', 'dis', 've']
+
+def vocabulary(rng, n=400):
+    return list(''.join(rng.choice(syllables) for i in range(rng.randint(1, 4)))
+                for i in range(n))
+
+class Writer:
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.words = vocabulary(self.rng)
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+
+    def word(self):
+        return self.rng.choice(self.words)
+
+    def phrase(self, low=2, high=5):
+        return ' '.join(self.word() for i in range(self.rng.randint(low, high)))
+
+    def sentence(self, inline=None):
+        """A sentence of plain words; inline, if given, makes the odd
+        extra piece (a macro, some math) to drop in between."""
+        parts = []
+        for i in range(self.rng.randint(5, 15)):
+            if inline is not None and self.rng.random() < 0.15:
+                parts.append(inline())
+            else:
+                parts.append(self.word())
+            if self.rng.random() < 0.08:
+                parts[-1] += ','
+        return parts[0].capitalize() + ' ' + ' '.join(parts[1:]) + '.'
+
+    def paragraph(self, inline=None):
+        self.write(' '.join(self.sentence(inline)
+                            for i in range(self.rng.randint(3, 6))))
+        self.write('\n\n')
+
+##############################################################################
+# shapes
+
+def paragraphs(w):
+    def inline():
+        return w.rng.choice([
+            lambda: '\\emph{%s}' % w.phrase(),
+            lambda: '\\textbf{%s}' % w.phrase(),
+            lambda: '\\cite{key%d}' % w.rng.randint(1, 50),
+            lambda: '%d' % w.rng.randint(1, 2000),
+            ])()
+    if w.rng.random() < 0.1:
+        w.write('\\section{%s}\n\n' % w.phrase().capitalize())
+    if w.rng.random() < 0.05:
+        w.write('%% %s\n' % w.phrase())
+    w.paragraph(inline)
+
+macro_definitions = (
+    '\\renewcommand*{\\sysname}{Lorem}\n'
+    '\\renewcommand*[1]{\\term}{\\textbf{term} #1}\n'
+    '\\renewcommand*[2]{\\pair}{#2 and #1}\n'
+    '\\renewcommand*{\\both}{\\sysname{} and \\term{x}}\n')
+
+def macros(w):
+    def inline():
+        return w.rng.choice([
+            lambda: '\\sysname{}',
+            lambda: '\\term{%s}' % w.phrase(1, 2),
+            lambda: '\\pair{%s}{%s}' % (w.word(), w.word()),
+            lambda: '\\both{}',
+            ])()
+    w.paragraph(inline)
+
+def nested(w):
+    depth = w.rng.randint(5, 40)
+    opening = []
+    for i in range(depth):
+        command = w.rng.choice(['', '', '\\emph', '\\textbf'])
+        opening.append('%s{%s ' % (command, w.phrase(1, 3)))
+    w.write(''.join(opening) + w.phrase() + '}' * depth + '\n\n')
+
+def math(w):
+    def symbol():
+        return w.rng.choice('xyzabn') + w.rng.choice(['', '_{i}', '^{2}', '_{i,j}'])
+    def formula():
+        return ' %s ' % w.rng.choice(['+', '-', '=', '\\leq']).join(
+            symbol() for i in range(w.rng.randint(2, 5)))
+    def inline():
+        return '$%s$' % formula()
+    w.paragraph(inline)
+    display = w.rng.choice([
+        '\\begin{equation}\n%s\n\\end{equation}\n\n',
+        '\\[ %s \\]\n\n',
+        '$$%s$$\n\n'])
+    w.write(display % formula())
+
+def environments(w):
+    kind = w.rng.choice(['itemize', 'enumerate', 'figure', 'table'])
+    if kind in ('itemize', 'enumerate'):
+        w.write('\\begin{%s}\n' % kind)
+        for i in range(w.rng.randint(2, 6)):
+            w.write('\\item %s\n' % w.sentence())
+            if w.rng.random() < 0.2:
+                w.write('\\begin{itemize}\n\\item %s\n\\end{itemize}\n' % w.sentence())
+        w.write('\\end{%s}\n\n' % kind)
+    else:
+        w.write('\\begin{%s}\n\\centering\n%s\n\\caption{%s}\n\\label{%s:%s}\n'
+                '\\end{%s}\n\n' % (kind, w.phrase(), w.sentence(), kind[:3],
+                                   w.word(), kind))
+    w.paragraph()
+
+shapes = {
+    'paragraphs': paragraphs,
+    'macros': macros,
+    'nested': nested,
+    'math': math,
+    'environments': environments,
+    }
+
+def generate(size, shape='paragraphs', seed=0):
+    """A document of at least size characters (but not much more)."""
+    w = Writer(seed)
+    w.write('\\documentclass{article}\n')
+    if shape == 'macros':
+        w.write(macro_definitions)
+    w.write('\\begin{document}\n\n')
+    end = '\\end{document}\n'
+    piece = shapes[shape]
+    while w.size + len(end) < size:
+        piece(w)
+    w.write(end)
+    return ''.join(w.parts)
+
+##############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('size', type=int, help='target size in characters')
+    parser.add_argument('shape', nargs='?', default='paragraphs',
+                        choices=sorted(shapes))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.size, args.shape, args.seed), end='')